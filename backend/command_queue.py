@@ -0,0 +1,78 @@
+import os
+from collections import deque
+from queue import Empty
+
+class CommandQueue:
+    """
+    Queue between the input handler (producer) and HidService (consumer).
+    Every put also signals a wakeup fd (an eventfd, or a self-pipe where eventfd is unavailable),
+    so the consumer's GLib main loop can sleep on fileno() and wake only when there is actually work,
+    instead of polling on a timer.
+    Items live in a deque: append() and popleft() are atomic, so a single producer and a single consumer
+    need no mutex or condition variable (queue.SimpleQueue would still take its internal lock on every put).
+    The wakeup fd replaces blocking get(). Nothing joins this queue, so there is no task_done().
+    """
+    def __init__(self):
+        self.queue = deque() # Same attribute name as queue.Queue, for peeking in debug code
+        if hasattr(os, 'eventfd'): # Linux, Python 3.10+
+            self._wake_fd = os.eventfd(0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)
+            self._wake_w = None # No separate write end
+        else:
+            self._wake_fd, self._wake_w = os.pipe()
+            os.set_blocking(self._wake_fd, False)
+            os.set_blocking(self._wake_w, False)
+
+    def put(self, item):
+        self.queue.append(item)
+        self.wake()
+
+    put_nowait = put
+
+    def put_many(self, items):
+        """Appends all items and signals the consumer once for the whole batch."""
+        self.queue.extend(items)
+        self.wake()
+
+    def get_nowait(self):
+        """Returns the oldest item, or raises queue.Empty."""
+        try:
+            return self.queue.popleft()
+        except IndexError:
+            raise Empty from None
+
+    def empty(self):
+        return not self.queue
+
+    def qsize(self):
+        return len(self.queue)
+
+    def wake(self):
+        """Makes fileno() readable without enqueueing anything (e.g. so the consumer notices a stop request)."""
+        if self._wake_w is None:
+            os.eventfd_write(self._wake_fd, 1)
+        else:
+            try:
+                os.write(self._wake_w, b'\x01')
+            except BlockingIOError: # Pipe full: the consumer already has a pending wakeup
+                pass
+
+    def fileno(self):
+        """The fd that becomes readable whenever items have been put."""
+        return self._wake_fd
+
+    def clear_wakeup(self):
+        """Resets the wakeup fd. Call before draining so no put is missed."""
+        try:
+            if self._wake_w is None:
+                os.eventfd_read(self._wake_fd)
+            else:
+                while os.read(self._wake_fd, 4096):
+                    pass
+        except BlockingIOError: # Nothing pending
+            pass
+
+    def close(self):
+        """Closes the wakeup fd(s). Only call once producer and consumer have stopped."""
+        os.close(self._wake_fd)
+        if self._wake_w is not None:
+            os.close(self._wake_w)
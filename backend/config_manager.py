@@ -1,81 +1,253 @@
+import copy
+import hashlib
 import json
 import logging # Use standard logging
 import os
+import sys
 import threading
+from contextlib import contextmanager
+from types import MappingProxyType
+
+try:
+    from .keycodes import MOD_NONE, get_codes # Imported as part of the backend package (GUI app)
+except ImportError:
+    from keycodes import MOD_NONE, get_codes # backend/main.py puts backend/ itself on sys.path
+
+try:
+    import orjson # Much faster parse/serialize, and works on bytes directly
+except ImportError:
+    orjson = None # Fall back to the stdlib json module
 
 # Use the logger configured in main_gui_app.py or a specific one
 logger = logging.getLogger("ConfigManager") # Changed from "ConfigManager"
 
+def _json_loads(data):
+    return orjson.loads(data) if orjson else json.loads(data)
+
+def _json_dumps(obj):
+    """Serializes obj to indented, key-sorted UTF-8 bytes (sort_keys for consistent output)."""
+    if orjson:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS)
+    return json.dumps(obj, indent=2, sort_keys=True).encode('utf-8')
+
+def _digest(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+def _freeze(value):
+    """Lists become tuples, with their strings interned: key names from JSON are fresh objects, interned ones
+       hit the identity fast path when probed against the (literal, already interned) keycode table keys.
+    """
+    if isinstance(value, list):
+        return tuple(sys.intern(item) if type(item) is str else item for item in value)
+    return value
+
+def _freeze_entry(entry):
+    """Read-only view of one mapping entry, as handed out by get_mappings."""
+    return MappingProxyType({k: _freeze(v) for k, v in entry.items()})
+
+def _compile_entry(entry):
+    """Resolves one mapping entry to {"type", "mod", "codes", "report"}."""
+    mod_mask = MOD_NONE
+    codes = []
+    for key_name in entry.get("keys", []):
+        if not key_name or key_name.upper() == "NONE": continue
+        key_mod, key_code = get_codes(key_name)
+        mod_mask |= key_mod
+        if key_code != 0x00 and key_code not in codes:
+            codes.append(key_code)
+    # Complete 8-byte keyboard report with only this mapping's keys down, for taps sent from an idle keyboard
+    report = bytes([mod_mask, 0, *codes[:6]]).ljust(8, b'\x00')
+    return MappingProxyType({"type": entry.get("type"), "mod": mod_mask, "codes": tuple(codes), "report": report})
+
+# Define default mappings - USE KEY NAMES from keycodes.py!
+# These actions should correspond to what input_handler.py can detect
+_DEFAULT_CONFIG = {
+    "knob_cw": {"type": "key_tap", "keys": ["VOLUME_UP"]},
+    "knob_ccw": {"type": "key_tap", "keys": ["VOLUME_DOWN"]},
+    "front_button_press": {"type": "key_press", "keys": ["LEFT_CTRL"]}, # Example: Just Ctrl press
+    "front_button_release": {"type": "key_release", "keys": ["LEFT_CTRL"]}, # Example: Ctrl release
+    "top_button_1_press": {"type": "key_tap", "keys": ["A"]},
+    "top_button_1_release": {"type": "none"}, # Default no action on release
+    "top_button_2_press": {"type": "key_tap", "keys": ["B"]},
+    "top_button_2_release": {"type": "none"},
+    "top_button_3_press": {"type": "key_tap", "keys": ["C"]},
+    "top_button_3_release": {"type": "none"},
+    "top_button_4_press": {"type": "key_tap", "keys": ["D"]},
+    "top_button_4_release": {"type": "none"},
+}
+# Every action input_handler can detect, in default config order
+DEFAULT_ACTIONS = tuple(_DEFAULT_CONFIG)
+
+SAVE_DEBOUNCE_SECONDS = 0.1 # update_action writes once this long after the last of a run of edits
+
+# Mapping "type" values understood by input_handler.py
+_MAPPING_TYPES = ("key_tap", "key_press", "key_release", "none")
+
+class _RWLock:
+    """Reader-writer lock: any number of concurrent readers, or one exclusive writer.
+       Waiting writers block new readers so a steady stream of reads cannot starve an update.
+    """
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = False
+        self._writers_waiting = 0
+
+    @contextmanager
+    def gen_rlock(self):
+        with self._cond:
+            while self._writer or self._writers_waiting:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if not self._readers:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def gen_wlock(self):
+        with self._cond:
+            self._writers_waiting += 1
+            while self._writer or self._readers:
+                self._cond.wait()
+            self._writers_waiting -= 1
+            self._writer = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer = False
+                self._cond.notify_all()
+
 class ConfigManager:
     def __init__(self, config_path):
         self.config_path = config_path
         self.config = {}
-        self.lock = threading.Lock() # Prevent race conditions when reading/writing
-        self.load_config()
+        # get_mappings runs on every input event, writes are rare: let readers proceed in parallel
+        self.lock = _RWLock()
+        self._snapshot = MappingProxyType({}) # Read-only view handed out by get_mappings
+        self.compiled = MappingProxyType({}) # {action: {"type", "mod", "codes"}} with key names resolved to HID codes
+        self._loaded = False # The file is read on first access rather than at construction
+        self._version = 0 # Bumped on every in-memory change, so late disk writes of older data can be dropped
+        self._file_lock = threading.Lock() # Serializes disk writes without blocking get_mappings readers
+        self._saved_version = -1
+        self._last_saved_hash = None # Digest of the bytes currently on disk, to skip rewriting identical content
+        self._save_timer = None # Pending debounced save scheduled by update_action
+        self._save_timer_lock = threading.Lock()
+        self._deferred_save_lock = threading.Lock() # Held while a debounced save runs, so flush() can wait it out
+        self._deferred_save_ok = True # Result of the last debounced save
+        self.on_deferred_save_error = None # Optional callable; runs (on the timer thread) when a debounced save fails
 
     def _get_default_config(self):
-        # Define default mappings - USE KEY NAMES from keycodes.py!
-        # These actions should correspond to what input_handler.py can detect
-        return {
-            "knob_cw": {"type": "key_tap", "keys": ["VOLUME_UP"]},
-            "knob_ccw": {"type": "key_tap", "keys": ["VOLUME_DOWN"]},
-            "front_button_press": {"type": "key_press", "keys": ["LEFT_CTRL"]}, # Example: Just Ctrl press
-            "front_button_release": {"type": "key_release", "keys": ["LEFT_CTRL"]}, # Example: Ctrl release
-            "top_button_1_press": {"type": "key_tap", "keys": ["A"]},
-            "top_button_1_release": {"type": "none"}, # Default no action on release
-            "top_button_2_press": {"type": "key_tap", "keys": ["B"]},
-            "top_button_2_release": {"type": "none"},
-            "top_button_3_press": {"type": "key_tap", "keys": ["C"]},
-            "top_button_3_release": {"type": "none"},
-            "top_button_4_press": {"type": "key_tap", "keys": ["D"]},
-            "top_button_4_release": {"type": "none"},
-        }
-
-    def load_config(self):
-        with self.lock:
+        return copy.deepcopy(_DEFAULT_CONFIG)
+
+    def _ensure_loaded(self):
+        if not self._loaded: # Double-checked in load_config under the write lock
+            self.load_config(only_if_unloaded=True)
+
+    def load_config(self, only_if_unloaded=False):
+        with self.lock.gen_wlock():
+            if only_if_unloaded and self._loaded:
+                return self.config
             try:
-                if os.path.exists(self.config_path):
-                    with open(self.config_path, 'r') as f:
-                        content = f.read()
-                        if not content: # Handle empty file case
-                            logger.warning(f"Config file {self.config_path} is empty, using defaults.")
-                            self.config = self._get_default_config()
-                            self.save_config() # Save defaults back to file
-                        else:
-                            self.config = json.loads(content)
-                            logger.info(f"Loaded configuration from {self.config_path}")
-                            # Optional: Validate or merge with defaults to ensure all actions exist
-                            default_conf = self._get_default_config()
-                            for key, value in default_conf.items():
-                                if key not in self.config:
-                                    logger.info(f"Adding missing default action '{key}' to config.")
-                                    self.config[key] = value
-                            # Remove keys from loaded config that are no longer in defaults (optional)
-                else:
-                    logger.warning(f"Config file not found at {self.config_path}. Creating with defaults.")
+                with open(self.config_path, 'rb') as f: # EAFP: no separate exists() check
+                    content = f.read()
+                if not content: # Handle empty file case
+                    logger.warning(f"Config file {self.config_path} is empty, using defaults.")
                     self.config = self._get_default_config()
-                    self.save_config()
+                    self._write_config() # Save defaults back to file
+                else:
+                    loaded = _json_loads(content)
+                    self.config = self._drop_invalid_entries(loaded)
+                    self._last_saved_hash = _digest(content)
+                    logger.info(f"Loaded configuration from {self.config_path}")
+                    matches_disk = self.config is loaded # Nothing was dropped or replaced
+                    # Optional: Validate or merge with defaults to ensure all actions exist
+                    for key, value in _DEFAULT_CONFIG.items():
+                        if key not in self.config:
+                            logger.info(f"Adding missing default action '{key}' to config.")
+                            self.config[key] = copy.deepcopy(value)
+                            matches_disk = False
+                    if matches_disk:
+                        # The in-memory config is what the file holds: identical updates can skip the write
+                        self._saved_version = self._version
+                    # Remove keys from loaded config that are no longer in defaults (optional)
+            except FileNotFoundError:
+                logger.warning(f"Config file not found at {self.config_path}. Creating with defaults.")
+                self.config = self._get_default_config()
+                self._write_config()
             except json.JSONDecodeError:
                 logger.error(f"Error decoding JSON from {self.config_path}. Using default config and attempting to save.")
                 self.config = self._get_default_config()
-                self.save_config() # Try to save a valid default config
+                self._write_config() # Try to save a valid default config
             except Exception as e:
                 logger.exception(f"Failed to load config: {e}. Using default config.")
                 self.config = self._get_default_config()
+            try:
+                self._rebuild_snapshot()
+                self._compile_mappings()
+            except Exception as e:
+                # Never leave the manager unloaded: every get_mappings() would raise from then on
+                logger.exception(f"Failed to prepare loaded config: {e}. Using default config.")
+                self.config = self._get_default_config()
+                self._rebuild_snapshot()
+                self._compile_mappings()
+            self._loaded = True
         return self.config # Return a copy to prevent accidental modification of internal state
 
+    def _rebuild_snapshot(self):
+        """Freezes self.config into the read-only view returned by get_mappings. Caller must hold the write lock."""
+        self._snapshot = MappingProxyType({
+            sys.intern(action): _freeze_entry(entry) for action, entry in self.config.items()
+        })
+
+    def _compile_mappings(self):
+        """Resolves every mapping's key names to (modifier_mask, keycodes) and a ready report once, so the HID
+           path only does integer work per event. Caller must hold the write lock.
+        """
+        self.compiled = MappingProxyType({action: _compile_entry(entry) for action, entry in self.config.items()})
+
     def save_config(self):
+        with self.lock.gen_rlock():
+            data, version = _json_dumps(self.config), self._version
+        return self._write_bytes(data, version)
+
+    def _write_config(self):
+        """Writes self.config to disk. Caller must hold the write lock."""
+        return self._write_bytes(_json_dumps(self.config), self._version)
+
+    def _write_bytes(self, data, version):
+        """Atomically replaces the config file with already serialized data, unless newer data was written meanwhile."""
         success = False
-        with self.lock:
+        with self._file_lock:
+            if version < self._saved_version:
+                logger.debug(f"Skipping save of config version {version}, version {self._saved_version} is already on disk.")
+                return True
+            digest = _digest(data)
+            if digest == self._last_saved_hash:
+                # No-op update (e.g. "save" without edits): spare the eMMC a rewrite
+                self._saved_version = version
+                logger.info(f"Configuration unchanged, not rewriting {self.config_path}")
+                return True
             try:
                 # Ensure directory exists if path includes directories
                 config_dir = os.path.dirname(self.config_path)
-                if config_dir and not os.path.exists(config_dir):
+                if config_dir:
                     os.makedirs(config_dir, exist_ok=True)
-                    logger.info(f"Created directory for config file: {config_dir}")
 
-                with open(self.config_path, 'w') as f:
-                    json.dump(self.config, f, indent=4, sort_keys=True) # sort_keys for consistent output
+                # Write to a temp file and rename it over the config so a crash mid-write
+                # can never leave a truncated config.json behind for load_config to trip over.
+                tmp_path = self.config_path + '.tmp'
+                with open(tmp_path, 'wb') as f:
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.config_path)
+                self._saved_version = version
+                self._last_saved_hash = digest
                 logger.info(f"Saved configuration to {self.config_path}")
                 success = True
             except Exception as e:
@@ -83,16 +255,157 @@ class ConfigManager:
         return success
 
     def get_mappings(self):
-        with self.lock:
-            # Return a deep copy to prevent modification outside the manager affecting internal state
-            return json.loads(json.dumps(self.config))
+        """Returns a read-only view of the mappings (key lists are tuples). Rebuilt only when the config changes."""
+        self._ensure_loaded()
+        with self.lock.gen_rlock():
+            return self._snapshot
+
+    def get_compiled(self):
+        """Returns the precompiled {action: {"type", "mod", "codes"}} view of the mappings."""
+        self._ensure_loaded()
+        with self.lock.gen_rlock():
+            return self.compiled
+
+    def get_mappings_and_compiled(self):
+        """Returns (get_mappings(), get_compiled()) read under one lock, so both views belong to the same config."""
+        self._ensure_loaded()
+        with self.lock.gen_rlock():
+            return self._snapshot, self.compiled
+
+    def get_mappings_mutable(self):
+        """Returns a plain dict copy of the mappings for callers that need to edit or serialize them."""
+        self._ensure_loaded()
+        with self.lock.gen_rlock():
+            return copy.deepcopy(self.config)
+
+    def _drop_invalid_entries(self, loaded):
+        """Returns the hand-editable file contents with malformed entries replaced by their defaults
+           (or removed, for unknown actions), so one bad entry cannot take the whole config down.
+        """
+        error = self._validate_mappings(loaded)
+        if error is None:
+            return loaded
+        if not isinstance(loaded, dict):
+            logger.error(f"Invalid config in {self.config_path}: {error} Using default config.")
+            return self._get_default_config()
+        config = {}
+        for action, entry in loaded.items():
+            error = self._validate_mappings({action: entry})
+            if error is None:
+                config[action] = entry
+            elif action in _DEFAULT_CONFIG:
+                logger.error(f"Invalid entry in {self.config_path}: {error} Using the default for '{action}'.")
+                config[action] = copy.deepcopy(_DEFAULT_CONFIG[action])
+            else:
+                logger.error(f"Invalid entry in {self.config_path}: {error} Ignoring it.")
+        return config
+
+    @staticmethod
+    def _validate_mappings(new_mappings):
+        """Returns a description of the first problem in new_mappings, or None if it is well formed."""
+        if not isinstance(new_mappings, dict):
+            return f"Expected dict, got {type(new_mappings)}."
+        for action, entry in new_mappings.items():
+            if not isinstance(action, str) or not isinstance(entry, dict):
+                return f"Mapping for {action!r} must be an object keyed by action name."
+            if entry.get("type") not in _MAPPING_TYPES:
+                return f"Mapping for '{action}' has unknown type {entry.get('type')!r}."
+            keys = entry.get("keys", [])
+            if not isinstance(keys, list) or not all(isinstance(k, str) for k in keys):
+                return f"Mapping for '{action}' must have a list of key names."
+        return None
 
     def update_mappings(self, new_mappings):
-        logger.debug(f"Attempting to update mappings with: {new_mappings}")
-        if isinstance(new_mappings, dict):
-             with self.lock:
-                self.config = new_mappings # Assume new_mappings is the complete valid set
-             return self.save_config()
-        else:
-            logger.error(f"Invalid data type provided for update_mappings. Expected dict, got {type(new_mappings)}.")
+        logger.debug("Attempting to update mappings with: %s", new_mappings) # Lazy: only formatted at DEBUG
+        # Reject malformed input before touching the lock
+        error = self._validate_mappings(new_mappings)
+        if error:
+            logger.error(f"Invalid mappings provided for update_mappings: {error}")
+            return False
+        with self.lock.gen_wlock():
+            if self._loaded and new_mappings == self.config and self._saved_version == self._version:
+                # Same mappings, already on disk: keep the current views so readers see nothing changed
+                logger.info("Mappings unchanged, nothing to update.")
+                return True
+            self.config = new_mappings # Assume new_mappings is the complete valid set
+            self._rebuild_snapshot()
+            self._compile_mappings()
+            self._loaded = True # The new set replaces whatever is on disk, no need to read it
+            self._version += 1
+            data, version = _json_dumps(self.config), self._version
+        # Disk I/O happens outside the exclusive section so readers are never blocked on fsync
+        return self._write_bytes(data, version)
+
+    def update_one(self, action, mapping):
+        """Replaces the mapping of a single action and saves. Only that entry is frozen and compiled again;
+           the views of the other actions are reused as they are.
+        """
+        changed = self._apply_one(action, mapping)
+        if changed is None:
+            return False
+        return self.save_config() if changed else True
+
+    def update_action(self, action, mapping):
+        """Like update_one, but the disk write is debounced: a run of edits is saved once,
+           SAVE_DEBOUNCE_SECONDS after the last one. Call flush() to write a pending change immediately.
+        """
+        changed = self._apply_one(action, mapping)
+        if changed is None:
             return False
+        if changed:
+            self._schedule_save()
+        return True
+
+    def _apply_one(self, action, mapping):
+        """Validates and applies one action's mapping in memory. Returns True if the config changed
+           (or is not on disk yet), False if there is nothing to write, None if the mapping is invalid.
+        """
+        logger.debug("Attempting to update mapping for '%s' with: %s", action, mapping)
+        error = self._validate_mappings({action: mapping})
+        if error:
+            logger.error(f"Invalid mapping provided for '{action}': {error}")
+            return None
+        self._ensure_loaded() # The other actions come from the current config
+        mapping = copy.deepcopy(mapping) # The caller keeps its dict
+        with self.lock.gen_wlock():
+            if self.config.get(action) == mapping:
+                if self._saved_version == self._version:
+                    logger.info(f"Mapping for '{action}' unchanged, nothing to update.")
+                    return False
+                return True # Same data, but an earlier save is still pending or failed
+            self.config[action] = mapping
+            self._snapshot = MappingProxyType({**self._snapshot, sys.intern(action): _freeze_entry(mapping)})
+            self.compiled = MappingProxyType({**self.compiled, action: _compile_entry(mapping)})
+            self._version += 1
+        return True
+
+    def _schedule_save(self):
+        """(Re)starts the debounce timer for a deferred save_config."""
+        with self._save_timer_lock:
+            if self._save_timer is not None:
+                self._save_timer.cancel()
+            self._save_timer = threading.Timer(SAVE_DEBOUNCE_SECONDS, self._deferred_save)
+            self._save_timer.daemon = True # flush() on shutdown writes whatever is still pending
+            self._save_timer.start()
+
+    def _deferred_save(self):
+        with self._deferred_save_lock: # Taken before the timer is cleared, so flush() cannot miss this save
+            with self._save_timer_lock:
+                self._save_timer = None
+            self._deferred_save_ok = self.save_config()
+        if not self._deferred_save_ok and self.on_deferred_save_error:
+            self.on_deferred_save_error()
+
+    def flush(self):
+        """Writes a change still waiting on the debounce timer, or waits for a debounced save already running.
+           Returns False if that write failed.
+        """
+        with self._save_timer_lock:
+            timer, self._save_timer = self._save_timer, None
+        if timer is not None:
+            timer.cancel() # Too late if it already fired; its save then runs after ours and finds nothing new
+        with self._deferred_save_lock:
+            if timer is None:
+                return self._deferred_save_ok # Nothing pending, or the callback in flight has just finished
+            self._deferred_save_ok = self.save_config()
+            return self._deferred_save_ok
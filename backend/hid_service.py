@@ -5,10 +5,15 @@ import logging
 import time
 import threading
 from gi.repository import GLib, GObject # Use GObject main loop for D-Bus
-import os # For os.write, os.read, os.close
+import os # For os.write, os.close
+import select
+import socket
+import struct
+from queue import SimpleQueue
+from xml.sax.saxutils import escape as xml_escape
 
 # Import keycodes
-from .keycodes import KeycodeMap # Relative import within package
+from .keycodes import MOD_NONE, get_codes # Relative import within package
 
 # Use the logger configured in main_gui_app.py or a specific one
 logger = logging.getLogger("HidService")
@@ -20,6 +25,8 @@ DEVICE_INTERFACE = 'org.bluez.Device1'
 PROFILE_MANAGER_INTERFACE = 'org.bluez.ProfileManager1'
 # HID_PROFILE_INTERFACE = 'org.bluez.HidProfile1' # This is what we implement, not a standard BlueZ one.
 HID_DBUS_PATH = '/org/example/bluez/custom_hid_profile' # Custom path for our profile registration
+DEFAULT_ADAPTER_PATH = '/org/bluez/hci0' # The only adapter on the Superbird; probed before enumerating BlueZ objects
+ADAPTER_SET_TIMEOUT = 5.0 # Seconds to wait for each adapter property Set reply (powering on the radio is the slow one)
 
 # Standard HID Keyboard Report Descriptor (simplified)
 # This one includes 1 report ID for keyboard.
@@ -48,6 +55,35 @@ SDP_RECORD_XML_TEMPLATE = """
   </attribute>
   <attribute id="0x0207"> <sequence><sequence> <uint16 value="0x0409" /> <uint16 value="0x0100" /> </sequence></sequence> </attribute> <attribute id="0x020B"> <boolean value="false" /> </attribute> <attribute id="0x020E"> <boolean value="true" /> </attribute> </record>
 """
+# Split once around the single substitution; the name is spliced in (escaped) at registration
+_SDP_PREFIX, _SDP_SUFFIX = SDP_RECORD_XML_TEMPLATE.split("{service_name}")
+
+# All keys up, no modifiers; copied into the report buffers instead of allocating new ones
+_EMPTY_REPORT = bytes(8)
+# Key slots 2-7 of the report, written in one C call; unused slots are padded from _ZERO_SLOTS
+_KEY_SLOTS = struct.Struct("6B")
+_ZERO_SLOTS = (0x00,) * 6
+
+# UUID for HID: 00001124-0000-1000-8000-00805f9b34fb
+HID_PROFILE_UUID = "00001124-0000-1000-8000-00805f9b34fb"
+
+# RegisterProfile options that do not depend on the device name, built once at import.
+# Native values: the call's 'osa{sv}' signature makes dbus-python wrap each one in a variant itself.
+_HID_PROFILE_STATIC_OPTS = {
+    "Role": "server", # We are the HID device (server role)
+    "RequireAuthentication": False, # Simpler pairing
+    "RequireAuthorization": False,
+    "AutoConnect": True, # Allow BlueZ to auto-connect to paired hosts
+    # "PSM": dbus.UInt16(0x0011), # PSM for HID Control (L2CAP_PSM_HID_CNTL), usually handled by SDP
+    # "Service": HID_PROFILE_UUID # Redundant if SDP has it
+}
+
+
+def _add_fd_watch(priority, fd, condition, callback):
+    """Watches a raw fd on the default main context; callback(fd, condition) returns False to remove the watch."""
+    if hasattr(GLib, 'unix_fd_add_full'): # No GIOChannel wrapper around the socket
+        return GLib.unix_fd_add_full(priority, fd, condition, callback)
+    return GLib.io_add_watch(fd, priority, condition, callback) # Older PyGObject
 
 
 class HidProfile(dbus.service.Object):
@@ -61,7 +97,14 @@ class HidProfile(dbus.service.Object):
         self.device_path = None # Object path of the connected host device
         self.interrupt_fd = -1
         self.interrupt_io_watch_id = 0
+        self._sock = None # Socket object wrapping interrupt_fd (owns it while connected)
+        self._rx_buf = bytearray(256) # Reused for every read from the host
         self.control_fd = -1 # Not typically used for basic keyboard output
+        self._report_queue = None # Reports waiting for the writer thread; None while not connected
+        self._writer_thread = None
+        self._writer_stop = None # threading.Event telling this connection's writer to quit
+        self._io_lock = None # Held around each write and around the close, so the fd never closes mid-write
+        self.backpressure_count = 0 # Times a report write hit a full socket buffer (EAGAIN)
         logger.info(f"HidProfile instance created at D-Bus path: {path}")
 
     @dbus.service.method(PROFILE_MANAGER_INTERFACE, in_signature="", out_signature="")
@@ -82,12 +125,20 @@ class HidProfile(dbus.service.Object):
 
             self.interrupt_fd = fd_dict['fd'].take() # take() transfers ownership of the FD
             logger.info(f"Interrupt channel FD {self.interrupt_fd} obtained for device {device_path}.")
-
-            # Add FD to GObject main loop for monitoring
-            # IO_IN for reading (e.g. LED status from host), IO_HUP/ERR for disconnects
-            self.interrupt_io_watch_id = GObject.io_add_watch(
+            self._sock = socket.socket(fileno=self.interrupt_fd) # Wraps (and now owns) the fd
+            # Non-blocking so neither the read callback nor the writer can stall on a full/empty socket buffer,
+            # and close-on-exec so the channel never leaks into child processes
+            self._sock.setblocking(False)
+            os.set_inheritable(self.interrupt_fd, False)
+            self._start_report_writer()
+
+            # Add FD to the GLib main loop for monitoring
+            # IO_IN for reading (e.g. LED status from host), IO_HUP/ERR for disconnects.
+            # High priority so host traffic and disconnects are dispatched ahead of queue processing.
+            self.interrupt_io_watch_id = _add_fd_watch(
+                GLib.PRIORITY_HIGH,
                 self.interrupt_fd,
-                GLib.IO_IN | GLib.IO_HUP | GLib.IO_ERR,
+                GLib.IOCondition.IN | GLib.IOCondition.HUP | GLib.IOCondition.ERR,
                 self.interrupt_channel_event_cb
             )
             logger.info(f"Watching interrupt channel FD {self.interrupt_fd} (watch_id: {self.interrupt_io_watch_id}).")
@@ -97,9 +148,12 @@ class HidProfile(dbus.service.Object):
 
         except Exception as e:
             logger.exception(f"Error setting up new HID connection for {device_path}: {e}")
+            self._stop_report_writer()
             if self.interrupt_fd != -1:
-                try: os.close(self.interrupt_fd)
+                try:
+                    self._close_channel()
                 except: pass
+                self._sock = None
                 self.interrupt_fd = -1
             # Potentially signal HidService to remove this failed profile instance or retry.
 
@@ -118,25 +172,28 @@ class HidProfile(dbus.service.Object):
             logger.error(f"Callback for unexpected fd {fd}, expecting {self.interrupt_fd}")
             return False # Remove watch
 
-        if conditions & (GLib.IO_HUP | GLib.IO_ERR):
+        if conditions & (GLib.IOCondition.HUP | GLib.IOCondition.ERR):
             logger.warning(f"Interrupt channel (fd {fd}, device {self.device_path}) closed or error (HUP/ERR). Conditions: {conditions}")
             self.cleanup_connection_resources()
-            return False # Remove watch, GObject.io_add_watch will do this automatically
+            return False # Remove watch
 
-        if conditions & GLib.IO_IN:
+        if conditions & GLib.IOCondition.IN:
             try:
                 # Read data received from host (e.g., LED status updates for CapsLock, NumLock)
-                data = os.read(fd, 1024) # Max buffer size
-                if not data: # Empty read can also mean channel closed
+                n = self._sock.recv_into(self._rx_buf) # Into the preallocated buffer
+                if not n: # Empty read can also mean channel closed
                     logger.warning(f"Empty read on interrupt channel (fd {fd}), treating as HUP.")
                     self.cleanup_connection_resources()
                     return False # Remove watch
-                logger.debug(f"Received data on interrupt channel (fd {fd}): {data.hex()}")
+                if logger.isEnabledFor(logging.DEBUG): # Skip the hex encode when debug logging is off
+                    logger.debug(f"Received data on interrupt channel (fd {fd}): {self._rx_buf[:n].hex()}")
                 # Handle SET_REPORT for LED status if your descriptor supports it
                 # Example: if data[0] == 0xa2 (HIDP_TRANS_DATA | HIDP_DATA_RTYPE_OUTPUT) for output report
                 # and data[1] is the report ID (if any, often not for simple LED).
                 # data[1] (or data[0] if no report ID) would contain LED state byte.
-                # self.hid_service.handle_led_update(data)
+                # self.hid_service.handle_led_update(memoryview(self._rx_buf)[:n])
+            except BlockingIOError: # Spurious wakeup, nothing to read
+                pass
             except OSError as e:
                 logger.error(f"OSError reading interrupt channel (fd {fd}): {e}")
                 self.cleanup_connection_resources()
@@ -149,35 +206,101 @@ class HidProfile(dbus.service.Object):
         return True # Keep watch active if no fatal error or HUP/ERR
 
     def send_report(self, report_bytes):
-        """Sends a HID report over the interrupt channel."""
-        if self.interrupt_fd != -1:
+        """Queues a HID report (bytes or bytearray) for the interrupt channel writer thread."""
+        if self.interrupt_fd != -1 and self._report_queue is not None:
+            # Snapshot the report: the caller keeps mutating its buffer while the write is pending
+            self._report_queue.put(bytes(report_bytes))
+            return True
+        logger.warning(f"Cannot send report: No active interrupt channel for device {self.device_path}.")
+        return False
+
+    def _start_report_writer(self):
+        """Starts the thread that performs the (potentially blocking) writes for this connection."""
+        self._report_queue = SimpleQueue()
+        self._writer_stop = threading.Event()
+        self._io_lock = threading.Lock()
+        self._writer_thread = threading.Thread(target=self._report_writer_loop,
+                                               args=(self._sock, self._report_queue, self._writer_stop, self._io_lock),
+                                               name="HidReportWriter", daemon=True)
+        self._writer_thread.start()
+
+    def _report_writer_loop(self, sock, report_queue, stop, io_lock):
+        """Writes queued reports in order off the GLib main loop, so a slow radio cannot stall D-Bus or the command queue."""
+        debug_enabled = logger.isEnabledFor(logging.DEBUG) # Checked once per connection, not per report
+        fd = sock.fileno()
+        writable = select.poll()
+        writable.register(fd, select.POLLOUT)
+        while True:
+            report = report_queue.get() # Blocks until there is work
+            if report is None or stop.is_set(): # Sentinel from _stop_report_writer
+                return
             try:
-                bytes_written = os.write(self.interrupt_fd, report_bytes)
-                logger.debug(f"Sent report ({bytes_written} bytes): {report_bytes.hex()}")
-                return True
+                while True:
+                    with io_lock: # cleanup_connection_resources closes the socket under the same lock
+                        if sock.fileno() == -1: # Already closed: the connection is gone
+                            return
+                        try:
+                            bytes_written = os.write(fd, report)
+                            break
+                        except BlockingIOError: # Send buffer full: back-pressure from the radio, not a dead connection
+                            self.backpressure_count += 1
+                    logger.debug("Interrupt channel fd %d busy, waiting to send (%d stalls so far).", fd, self.backpressure_count)
+                    events = writable.poll(100) # Outside the lock, so a teardown never waits on the radio
+                    if stop.is_set(): # Connection was torn down while waiting
+                        return
+                    if events and events[0][1] & (select.POLLHUP | select.POLLERR | select.POLLNVAL):
+                        raise OSError(f"Interrupt channel hung up (poll events 0x{events[0][1]:x})")
+                if debug_enabled:
+                    logger.debug(f"Sent report ({bytes_written} bytes): {report.hex()}")
             except OSError as e: # Can happen if host disconnects abruptly
-                logger.error(f"OSError sending report on fd {self.interrupt_fd} (device {self.device_path}): {e}")
-                self.cleanup_connection_resources() # Connection is likely dead
-            except Exception as e:
-                logger.exception(f"Unhandled error sending report on fd {self.interrupt_fd}: {e}")
-                self.cleanup_connection_resources()
+                logger.error(f"OSError sending report on fd {fd} (device {self.device_path}): {e}")
+                # Connection is likely dead; tear down in the GLib thread. The socket object identifies this
+                # connection: its fd number may already belong to a new one when the callback runs.
+                GLib.idle_add(self._on_report_write_error, sock)
+                return
+
+    def _on_report_write_error(self, sock):
+        if sock is self._sock: # Ignore if the connection was already replaced/cleaned up
+            self.cleanup_connection_resources()
+        return False # One-shot idle callback
+
+    def _stop_report_writer(self):
+        """Tells the writer thread to exit, without waiting for it. Reports still queued are dropped:
+           the connection is going away. A writer blocked on a full socket notices within one poll interval.
+        """
+        if self._report_queue is not None:
+            self._writer_stop.set()
+            self._report_queue.put(None) # Wakes a writer idle in get()
+        self._report_queue = None
+        self._writer_thread = None
+
+    def _close_channel(self):
+        """Closes the interrupt channel socket (or bare fd) once no write is in progress."""
+        if self._sock:
+            if self._io_lock is not None:
+                with self._io_lock: # Waits out at most one non-blocking write; the writer then sees fileno() == -1
+                    self._sock.close() # Closes interrupt_fd
+            else:
+                self._sock.close()
         else:
-            logger.warning(f"Cannot send report: No active interrupt channel for device {self.device_path}.")
-        return False
+            os.close(self.interrupt_fd)
 
     def cleanup_connection_resources(self):
         logger.info(f"Cleaning up HID connection resources for device {self.device_path} (fd: {self.interrupt_fd}).")
         if self.interrupt_io_watch_id > 0:
-            GObject.source_remove(self.interrupt_io_watch_id)
+            GLib.source_remove(self.interrupt_io_watch_id)
             self.interrupt_io_watch_id = 0
             logger.debug(f"Removed IO watch for fd {self.interrupt_fd}.")
 
+        self._stop_report_writer()
+
         if self.interrupt_fd != -1:
             try:
-                os.close(self.interrupt_fd)
+                self._close_channel() # Under the writer's lock, so it never writes to a closed (or reused) fd
                 logger.info(f"Closed interrupt channel FD {self.interrupt_fd} for {self.device_path}.")
             except OSError as e:
                 logger.error(f"Error closing interrupt channel FD {self.interrupt_fd}: {e}")
+            self._sock = None
             self.interrupt_fd = -1
 
         # Inform HidService that this connection is gone
@@ -197,18 +320,27 @@ class HidService:
         self.profile_instance = None # The D-Bus object for our profile
         self.adapter_path = None
         self.adapter_interface = None
+        self._adapter_props = None # Cached org.freedesktop.DBus.Properties proxy for the adapter
+        self.profile_manager = None # Cached ProfileManager1 proxy, shared by register/unregister
+        self._managed_objects = {} # BlueZ object tree; only fetched if the default adapter path is missing
+        self._adapter_signal_matches = [] # InterfacesAdded/Removed receivers, removed on cleanup
         self.mainloop = None # GObject/GLib MainLoop
         self.stop_requested_event = threading.Event()
         self.active_connection_profile = None # Stores the HidProfile instance for the currently connected host
-        self.keycode_map = KeycodeMap()
         self.bt_device_name = "NixMacroPad" # Default, can be overridden
 
         # Keyboard report state [Modifier, Reserved, Key1, Key2, Key3, Key4, Key5, Key6]
         # This matches the typical 8-byte HID keyboard report.
         self.report_state = bytearray([0x00] * 8)
         self.last_sent_report_state = bytearray([0x00] * 8) # To send only on change
+        # Keycodes currently held, in report slot order (max 6), and the same as a set for membership tests.
+        # These are authoritative for slots 2-7; report_state is only rewritten from them at send time.
+        self._pressed = []
+        self._pressed_set = set()
+        self._keys_dirty = False
 
         self._dbus_registration_id = 0 # For profile registration tracking
+        self._queue_watch_id = 0 # GLib source draining the command queue
 
     def _init_dbus_and_mainloop(self):
         """Initializes D-Bus connection and main loop in the current thread."""
@@ -219,67 +351,133 @@ class HidService:
         return True
 
     def _find_adapter(self):
-         """Finds the first available Bluetooth adapter."""
-         om = dbus.Interface(self.bus.get_object(BLUEZ_SERVICE_NAME, '/'), 'org.freedesktop.DBus.ObjectManager')
-         objects = om.GetManagedObjects()
-         for path, interfaces in objects.items():
-             if ADAPTER_INTERFACE in interfaces:
-                 self.adapter_path = path
-                 self.adapter_interface = dbus.Interface(self.bus.get_object(BLUEZ_SERVICE_NAME, path), ADAPTER_INTERFACE)
-                 logger.info(f"Found Bluetooth adapter: {path}")
-                 return True
+         """Finds the Bluetooth adapter (well-known path first, full object tree only as a fallback) and the ProfileManager."""
+         profile_manager_path = '/org/bluez' # Standard path for ProfileManager1
+         if self._probe_adapter(DEFAULT_ADAPTER_PATH):
+             self.adapter_path = DEFAULT_ADAPTER_PATH
+         else:
+             try:
+                 # One GetManagedObjects round-trip, shared by adapter and ProfileManager discovery
+                 om = dbus.Interface(self.bus.get_object(BLUEZ_SERVICE_NAME, '/', introspect=False),
+                                     'org.freedesktop.DBus.ObjectManager')
+                 self._managed_objects = om.GetManagedObjects()
+             except dbus.exceptions.DBusException as e:
+                 logger.error(f"Failed to query BlueZ objects (is bluetoothd running?): {e}")
+                 return False
+             for path, interfaces in self._managed_objects.items():
+                 if PROFILE_MANAGER_INTERFACE in interfaces:
+                     profile_manager_path = path
+                 if ADAPTER_INTERFACE in interfaces and not self.adapter_path:
+                     self.adapter_path = path
+         self._watch_adapters()
+         # introspect=False on every BlueZ proxy: the interfaces are fixed, so skip the Introspect round-trip.
+         # Without introspection dbus-python guesses argument types, so calls pass explicit signatures.
+         self.profile_manager = dbus.Interface(self.bus.get_object(BLUEZ_SERVICE_NAME, profile_manager_path, introspect=False),
+                                               PROFILE_MANAGER_INTERFACE)
+         if self.adapter_path:
+             adapter_obj = self.bus.get_object(BLUEZ_SERVICE_NAME, self.adapter_path, introspect=False)
+             self.adapter_interface = dbus.Interface(adapter_obj, ADAPTER_INTERFACE)
+             self._adapter_props = dbus.Interface(adapter_obj, 'org.freedesktop.DBus.Properties')
+             logger.info(f"Found Bluetooth adapter: {self.adapter_path}")
+             return True
          logger.error("Could not find a Bluetooth adapter.")
          return False
 
+    def _probe_adapter(self, path):
+        """True if an Adapter1 exists at path; a single small Properties.Get instead of the whole object tree."""
+        try:
+            obj = self.bus.get_object(BLUEZ_SERVICE_NAME, path, introspect=False)
+            dbus.Interface(obj, 'org.freedesktop.DBus.Properties').Get(ADAPTER_INTERFACE, "Address", signature='ss')
+            return True
+        except dbus.exceptions.DBusException as e:
+            logger.debug(f"No adapter at {path}: {e}")
+            return False
+
+    def _watch_adapters(self):
+        """Subscribes to BlueZ ObjectManager signals so adapter hotplug is noticed without re-enumerating."""
+        if self._adapter_signal_matches:
+            return
+        for signal_name, handler in (("InterfacesAdded", self._on_interfaces_added),
+                                     ("InterfacesRemoved", self._on_interfaces_removed)):
+            self._adapter_signal_matches.append(self.bus.add_signal_receiver(
+                handler, signal_name=signal_name, dbus_interface='org.freedesktop.DBus.ObjectManager',
+                bus_name=BLUEZ_SERVICE_NAME))
+
+    def _on_interfaces_added(self, path, interfaces):
+        if ADAPTER_INTERFACE in interfaces: # Also fires for every discovered device; ignore those
+            self._managed_objects[path] = interfaces
+            logger.info(f"Bluetooth adapter appeared: {path}")
+
+    def _on_interfaces_removed(self, path, interfaces):
+        if ADAPTER_INTERFACE in interfaces:
+            self._managed_objects.pop(path, None)
+            if path == self.adapter_path:
+                logger.warning(f"Active Bluetooth adapter {path} was removed.")
+            else:
+                logger.info(f"Bluetooth adapter removed: {path}")
+
     def _set_adapter_properties(self, device_name="NixMacroPad"):
         """Sets the adapter to be discoverable, pairable, and sets its alias."""
         self.bt_device_name = device_name
-        if not self.adapter_interface:
+        if not self._adapter_props:
             logger.error("Adapter not available to set properties.")
             return False
-        try:
-            props = dbus.Interface(self.adapter_interface, 'org.freedesktop.DBus.Properties')
-            props.Set(ADAPTER_INTERFACE, "Powered", dbus.Boolean(True))
-            logger.info("Adapter Powered: On")
-            props.Set(ADAPTER_INTERFACE, "Discoverable", dbus.Boolean(True))
-            logger.info("Adapter Discoverable: On")
-            props.Set(ADAPTER_INTERFACE, "Pairable", dbus.Boolean(True))
-            logger.info("Adapter Pairable: On")
-            props.Set(ADAPTER_INTERFACE, "Alias", dbus.String(self.bt_device_name)) # This is the name shown to other devices
-            logger.info(f"Adapter Alias set to: {self.bt_device_name}")
-            return True
-        except dbus.exceptions.DBusException as e:
-            logger.error(f"Failed to set adapter properties: {e}")
-            return False
+        # Plain Python values: dbus-python marshals bool -> 'b' and str -> 's' inside the variant itself.
+        # Powered goes first on its own (BlueZ may reject Discoverable on a powered-off adapter);
+        # the remaining three are independent and are issued together.
+        ok = self._set_adapter_props_async({"Powered": True})
+        ok = self._set_adapter_props_async({
+            "Discoverable": True,
+            "Pairable": True,
+            "Alias": self.bt_device_name, # This is the name shown to other devices
+        }) and ok
+        return ok
+
+    def _set_adapter_props_async(self, values):
+        """Sends one Properties.Set per entry without waiting in between, then waits for all replies."""
+        outstanding = set(values)
+        failed = []
+
+        def on_reply(name):
+            outstanding.discard(name)
+            logger.info(f"Adapter {name} set to: {values[name]}")
+
+        def on_error(name, e):
+            outstanding.discard(name)
+            failed.append(name)
+            logger.error(f"Failed to set adapter property {name}: {e}")
+
+        for name, value in values.items():
+            try:
+                self._adapter_props.Set(ADAPTER_INTERFACE, name, value, signature='ssv',
+                                        reply_handler=lambda name=name: on_reply(name),
+                                        error_handler=lambda e, name=name: on_error(name, e),
+                                        timeout=ADAPTER_SET_TIMEOUT)
+            except dbus.exceptions.DBusException as e:
+                on_error(name, e)
+
+        # The main loop is not running yet: dispatch the replies (or D-Bus timeouts) from here
+        context = GLib.MainContext.default()
+        while outstanding:
+            context.iteration(True)
+        return not failed
 
     def _register_hid_profile(self):
         """Registers the custom HID profile with BlueZ."""
         try:
-            profile_manager = dbus.Interface(
-                self.bus.get_object(BLUEZ_SERVICE_NAME, '/org/bluez'), # Standard path for ProfileManager1
-                PROFILE_MANAGER_INTERFACE
-            )
-
             # Instantiate our D-Bus service object (the profile)
             # Pass a reference to self (HidService) so the profile can call back
             self.profile_instance = HidProfile(self.bus, HID_DBUS_PATH, self)
 
-            # Profile options
-            # UUID for HID: 00001124-0000-1000-8000-00805f9b34fb
-            profile_uuid = "00001124-0000-1000-8000-00805f9b34fb"
-            opts = {
-                "Name": dbus.String(self.bt_device_name + " Profile"), # Profile name in BlueZ (internal)
-                "ServiceRecord": dbus.String(SDP_RECORD_XML_TEMPLATE.format(service_name=self.bt_device_name)),
-                "Role": dbus.String("server"), # We are the HID device (server role)
-                "RequireAuthentication": dbus.Boolean(False), # Simpler pairing
-                "RequireAuthorization": dbus.Boolean(False),
-                "AutoConnect": dbus.Boolean(True), # Allow BlueZ to auto-connect to paired hosts
-                # "PSM": dbus.UInt16(0x0011), # PSM for HID Control (L2CAP_PSM_HID_CNTL), usually handled by SDP
-                # "Service": profile_uuid # Redundant if SDP has it
-            }
+            # Profile options: only the name-dependent entries are built here
+            opts = dict(_HID_PROFILE_STATIC_OPTS)
+            opts["Name"] = self.bt_device_name + " Profile" # Profile name in BlueZ (internal)
+            # The adapter alias is user-settable, so escape it for the attribute value
+            service_record = _SDP_PREFIX + xml_escape(self.bt_device_name, {'"': "&quot;"}) + _SDP_SUFFIX
+            opts["ServiceRecord"] = service_record
             # RegisterProfile arguments: path, UUID, options
-            profile_manager.RegisterProfile(HID_DBUS_PATH, profile_uuid, opts)
-            logger.info(f"HID Profile registered successfully with BlueZ at path {HID_DBUS_PATH} and UUID {profile_uuid}.")
+            self.profile_manager.RegisterProfile(HID_DBUS_PATH, HID_PROFILE_UUID, opts, signature='osa{sv}')
+            logger.info(f"HID Profile registered successfully with BlueZ at path {HID_DBUS_PATH} and UUID {HID_PROFILE_UUID}.")
             return True
         except dbus.exceptions.DBusException as e:
             # Common error: org.bluez.Error.AlreadyExists if path is already registered
@@ -295,15 +493,11 @@ class HidService:
 
 
     def _unregister_hid_profile(self):
-        if not self.bus or not self.profile_instance:
+        if not self.bus or not self.profile_manager or not self.profile_instance:
             logger.info("Cannot unregister profile: D-Bus or profile instance not available.")
             return
         try:
-            profile_manager = dbus.Interface(
-                self.bus.get_object(BLUEZ_SERVICE_NAME, '/org/bluez'),
-                PROFILE_MANAGER_INTERFACE
-            )
-            profile_manager.UnregisterProfile(HID_DBUS_PATH)
+            self.profile_manager.UnregisterProfile(HID_DBUS_PATH, signature='o')
             logger.info(f"HID Profile at {HID_DBUS_PATH} unregistered successfully.")
         except dbus.exceptions.DBusException as e:
             # Common error: org.bluez.Error.DoesNotExist if it was never registered or already gone.
@@ -320,8 +514,16 @@ class HidService:
                 self.profile_instance = None
 
 
+    def _on_command_queue_wake(self, fd, condition):
+        """GLib fd callback: the command queue's eventfd became readable."""
+        self.command_queue.clear_wakeup() # Reset before draining so a concurrent put re-arms the fd
+        keep_watch = self._command_queue_processor_cb()
+        if not keep_watch:
+            self._queue_watch_id = 0 # GLib removes the source when we return False
+        return keep_watch
+
     def _command_queue_processor_cb(self):
-        """GLib timeout callback to process commands from the input_handler queue."""
+        """Drains the input_handler command queue and sends at most one report for the whole batch."""
         if self.stop_requested_event.is_set():
             logger.info("Command queue processor stopping as service stop is requested.")
             return False # Do not reschedule
@@ -332,22 +534,46 @@ class HidService:
                 if self.stop_requested_event.is_set(): break # Check again inside loop
 
                 command = self.command_queue.get_nowait() # Non-blocking
-                logger.debug(f"Processing command from queue: {command}")
+                logger.debug("Processing command from queue: %s", command) # Lazy: formatted only if DEBUG is on
 
                 command_type = command.get('type')
-                key_names = command.get('keys', []) # List of key names like "A", "LEFT_CTRL"
 
-                if command_type == 'press':
-                    self._update_report_for_keys(key_names, press=True)
-                elif command_type == 'release':
-                    self._update_report_for_keys(key_names, press=False)
+                if command_type in ('press', 'release', 'tap'):
+                    if 'codes' in command: # Precompiled by ConfigManager, no key name lookups needed
+                        mod_mask, key_codes = command['mod'], command['codes']
+                    else:
+                        key_names = command.get('keys', []) # List of key names like "A", "LEFT_CTRL"
+                        if not isinstance(key_names, (list, tuple)):
+                            logger.warning(f"Command keys is not a list: {key_names}. Skipping.")
+                            continue
+                        mod_mask, key_codes = self._resolve_key_names(key_names)
+                    if command_type == 'tap':
+                        report = command.get('report')
+                        if report is not None and report != _EMPTY_REPORT and self._is_idle():
+                            # Nothing else held: the press report is exactly the precompiled one
+                            self._send_tap_reports(report, command.get('count', 1))
+                            processed_command = True
+                            continue
+                        # Press and release `count` times (coalesced knob detents); every edge must reach the host
+                        for _ in range(command.get('count', 1)):
+                            self._update_report_for_codes(mod_mask, key_codes, True)
+                            self._try_send_current_report_if_changed()
+                            self._update_report_for_codes(mod_mask, key_codes, False)
+                            self._try_send_current_report_if_changed()
+                    else:
+                        press = command_type == 'press'
+                        if not press and self._release_undoes_pending(mod_mask, key_codes):
+                            # This release would cancel a press the host has not seen yet (e.g. a tap drained
+                            # in one batch): emit that intermediate state first. Every other change is coalesced.
+                            self._try_send_current_report_if_changed()
+                        self._update_report_for_codes(mod_mask, key_codes, press)
                 else:
                     logger.warning(f"Unknown command type in queue: {command_type}")
 
-                self.command_queue.task_done()
                 processed_command = True
 
             if processed_command:
+                # All state changes of the batch are applied above; emit a single report for them
                 self._try_send_current_report_if_changed()
 
         except Exception as e:
@@ -356,69 +582,122 @@ class HidService:
         return True # Reschedule this callback
 
 
+    def _is_idle(self):
+        """True if no key or modifier is held and the host has been told so."""
+        self._serialize_pressed_keys()
+        return self.report_state == _EMPTY_REPORT and self.last_sent_report_state == _EMPTY_REPORT
+
+    def _send_tap_reports(self, report, count):
+        """Sends a precompiled press report and an empty release report `count` times, bypassing the key state."""
+        profile = self.active_connection_profile
+        if not profile:
+            logger.debug("No active HID connection to send report to.")
+            return
+        last_sent = self.last_sent_report_state
+        for _ in range(count):
+            if not profile.send_report(report):
+                return
+            last_sent[:] = report
+            if not profile.send_report(_EMPTY_REPORT):
+                return
+            last_sent[:] = _EMPTY_REPORT
+
     def _update_report_for_keys(self, key_names_list, press):
         """
         Updates the internal self.report_state based on a list of key names.
-        key_names_list: A list of strings like ["LEFT_CTRL", "C"].
+        key_names_list: A list (or tuple) of strings like ["LEFT_CTRL", "C"].
         press: Boolean, True to press, False to release.
         """
-        if not isinstance(key_names_list, list):
+        if not isinstance(key_names_list, (list, tuple)):
             logger.warning(f"key_names_list is not a list: {key_names_list}. Skipping update.")
             return
 
+        mod_mask, key_codes = self._resolve_key_names(key_names_list)
+        self._update_report_for_codes(mod_mask, key_codes, press)
+
+    def _resolve_key_names(self, key_names_list):
+        """Returns (modifier_mask, [keycodes]) for a list of key names."""
+        mod_mask = MOD_NONE
+        key_codes = []
         for key_name in key_names_list:
-            if not key_name or key_name.upper() == "NONE": continue # Skip empty or "NONE" keys
+            if not key_name: continue # Skip empty keys
+            # Cached per name; unknown names and "NONE" resolve to (0, 0), a no-op
+            mod_mask_for_key, key_code_for_key = get_codes(key_name)
+            mod_mask |= mod_mask_for_key
+            if key_code_for_key != 0x00 and key_code_for_key not in key_codes:
+                key_codes.append(key_code_for_key)
+        return mod_mask, key_codes
+
+    def _release_undoes_pending(self, mod_mask, key_codes):
+        """True if releasing these codes would clear a modifier/key that is pressed but not yet sent."""
+        last_sent = self.last_sent_report_state
+        if mod_mask & self.report_state[0] & ~last_sent[0]:
+            return True
+        for key_code in key_codes:
+            if key_code in self._pressed_set and last_sent.find(key_code, 2) == -1:
+                return True
+        return False
 
-            mod_mask_for_key, key_code_for_key = self.keycode_map.get_codes(key_name)
 
-            # Update modifier byte (self.report_state[0])
-            if mod_mask_for_key != self.keycode_map.MOD_NONE: # If this key IS a modifier
-                if press:
-                    self.report_state[0] |= mod_mask_for_key
+    def _update_report_for_codes(self, mod_mask, key_codes, press):
+        """
+        Updates the internal self.report_state from already-resolved HID codes.
+        mod_mask: OR of the modifier bits to set/clear.
+        key_codes: Sequence of non-zero HID usage IDs.
+        press: Boolean, True to press, False to release.
+        """
+        report_state = self.report_state
+        # Update modifier byte (self.report_state[0])
+        if mod_mask != MOD_NONE:
+            if press:
+                report_state[0] |= mod_mask
+            else:
+                report_state[0] &= ~mod_mask
+
+        # Update regular key codes: track pressed keys in an ordered list (report slot order, max 6)
+        # plus a set for O(1) membership, then rewrite slots 2-7 from the list.
+        pressed, pressed_set = self._pressed, self._pressed_set
+        keys_changed = False
+        for key_code_for_key in key_codes:
+            if press:
+                if key_code_for_key in pressed_set:
+                    continue
+                if len(pressed) < 6:
+                    pressed.append(key_code_for_key)
+                    pressed_set.add(key_code_for_key)
+                    keys_changed = True
                 else:
-                    self.report_state[0] &= ~mod_mask_for_key
-
-            # Update regular key codes (self.report_state[2] to self.report_state[7])
-            # Only if the key_code_for_key is not 0x00 (which it is for pure modifier keys)
-            if key_code_for_key != 0x00:
-                if press:
-                    # Add key_code if not already present in report_state[2:8] and there's space
-                    is_present = False
-                    first_empty_slot = -1
-                    for i in range(2, 8): # Slots for keycodes are index 2 through 7
-                        if self.report_state[i] == key_code_for_key:
-                            is_present = True
-                            break
-                        if self.report_state[i] == 0x00 and first_empty_slot == -1:
-                            first_empty_slot = i
-                    if not is_present and first_empty_slot != -1:
-                        self.report_state[first_empty_slot] = key_code_for_key
-                    elif not is_present: # and first_empty_slot == -1 (no space)
-                        logger.warning(f"HID report key slots full (max 6). Cannot press '{key_name}'. Current: {self.report_state[2:].hex()}")
-                else: # Release
-                    # Remove key_code from report_state[2:8]
-                    for i in range(2, 8):
-                        if self.report_state[i] == key_code_for_key:
-                            self.report_state[i] = 0x00
-                            # Typically, HID keyboards don't re-pack keys on release, just zero them out.
-                            # If repacking is desired (to always fill from left):
-                            # temp_keys = [k for k in self.report_state[2:8] if k != 0x00]
-                            # self.report_state[2:8] = bytearray(temp_keys + [0x00]*(6-len(temp_keys)))
-                            break # Assuming a key is only pressed once
-
-        logger.debug(f"Report state after update for '{key_names_list}' (press={press}): {self.report_state.hex()}")
+                    logger.warning(f"HID report key slots full (max 6). Cannot press 0x{key_code_for_key:02x}. Current: {bytes(pressed).hex()}")
+            elif key_code_for_key in pressed_set: # Release
+                pressed.remove(key_code_for_key)
+                pressed_set.discard(key_code_for_key)
+                keys_changed = True
+
+        if keys_changed:
+            self._keys_dirty = True # Serialized into slots 2-7 once per send, not once per update
+
+        if logger.isEnabledFor(logging.DEBUG): # Skip building the hex dump when debug logging is off
+            logger.debug(f"Key state after update for codes {list(key_codes)} mod=0x{mod_mask:02x} (press={press}): modifier=0x{report_state[0]:02x} keys={bytes(pressed).hex()}")
+
+    def _serialize_pressed_keys(self):
+        """Writes the tracked keys into report slots 2-7 in place, packed to the left."""
+        if self._keys_dirty:
+            pressed = self._pressed
+            _KEY_SLOTS.pack_into(self.report_state, 2, *pressed, *_ZERO_SLOTS[len(pressed):])
+            self._keys_dirty = False
 
 
     def _try_send_current_report_if_changed(self):
         """Sends the current keyboard report state if it changed from the last sent state."""
+        self._serialize_pressed_keys()
         if self.report_state != self.last_sent_report_state:
             if self.active_connection_profile:
                 # Report ID for standard keyboard is 0x01, but often not prefixed if descriptor only has one report.
                 # The provided descriptor seems to imply no explicit report ID prefix for keyboard data.
                 # If issues, try report = b'\x01' + self.report_state
-                report_to_send = bytes(self.report_state) # Ensure it's bytes
-                if self.active_connection_profile.send_report(report_to_send):
-                    self.last_sent_report_state = self.report_state[:] # Store a copy
+                # send_report takes its own snapshot for the writer thread, so pass the live buffer
+                if self.active_connection_profile.send_report(self.report_state):
+                    self.last_sent_report_state[:] = self.report_state # Copy into the existing buffer
             else:
                  logger.debug("No active HID connection to send report to.")
         # else:
@@ -426,11 +705,13 @@ class HidService:
 
     def _send_empty_report(self):
         """Sends an empty report (all keys up, no modifiers)."""
-        empty_report = bytearray([0x00] * 8)
         if self.active_connection_profile:
-            if self.active_connection_profile.send_report(bytes(empty_report)):
-                 self.last_sent_report_state = empty_report[:]
-                 self.report_state = empty_report[:] # Reset internal state too
+            if self.active_connection_profile.send_report(_EMPTY_REPORT):
+                 self.last_sent_report_state[:] = _EMPTY_REPORT
+                 self.report_state[:] = _EMPTY_REPORT # Reset internal state too
+                 self._pressed.clear()
+                 self._pressed_set.clear()
+                 self._keys_dirty = False
         logger.info("Sent empty HID report (all keys up).")
 
 
@@ -452,8 +733,11 @@ class HidService:
         if self.active_connection_profile == profile_conn_instance:
             self.active_connection_profile = None
             # Reset report state on disconnect to avoid stale key presses on reconnect
-            self.report_state = bytearray([0x00] * 8)
-            self.last_sent_report_state = bytearray([0x00] * 8)
+            self.report_state[:] = _EMPTY_REPORT
+            self.last_sent_report_state[:] = _EMPTY_REPORT
+            self._pressed.clear()
+            self._pressed_set.clear()
+            self._keys_dirty = False
             logger.info(f"HID Service: Active connection with {dev_path} unregistered.")
         else:
              logger.warning(f"Attempt to unregister an unknown/inactive connection profile for {dev_path}.")
@@ -480,11 +764,15 @@ class HidService:
             self.stop()
             return
 
-        # Add command queue processor to the main loop, checks every ~20ms
-        # Lower value for more responsiveness, higher for less CPU.
-        # Needs to be frequent enough to feel responsive.
-        GObject.timeout_add(20, self._command_queue_processor_cb)
-        logger.info("HID Service command queue processor scheduled.")
+        if hasattr(self.command_queue, 'fileno'):
+            # CommandQueue signals an eventfd on put: the main loop only wakes when there is work
+            self._queue_watch_id = _add_fd_watch(GLib.PRIORITY_DEFAULT, self.command_queue.fileno(),
+                                                 GLib.IOCondition.IN, self._on_command_queue_wake)
+            logger.info("HID Service command queue processor watching queue eventfd.")
+        else:
+            # Plain queue.Queue: no wakeup fd, fall back to polling every ~20ms
+            self._queue_watch_id = GObject.timeout_add(20, self._command_queue_processor_cb)
+            logger.info("HID Service command queue processor scheduled.")
         logger.info("HID Service running. Waiting for connections/commands...")
 
         try:
@@ -495,7 +783,8 @@ class HidService:
             logger.exception(f"Error running HID service main loop: {e}")
         finally:
             logger.info("HID Service main loop exited.")
-            # Cleanup is handled in stop(), which should be called by the main app's on_stop or equivalent.
+            # Cleanup is handled by _shutdown(), which stop() (called by the main app's on_stop or equivalent)
+            # schedules in this loop before it quits.
             # If run() exits due to an error before stop() is called from outside,
             # we should ensure cleanup here too.
             if not self.stop_requested_event.is_set(): # If stop wasn't called explicitly
@@ -512,26 +801,30 @@ class HidService:
 
         self._unregister_hid_profile()
 
-        # Other cleanups like removing D-Bus signal watches if any were added directly by HidService.
+        # Remove D-Bus signal watches added directly by HidService.
+        for match in self._adapter_signal_matches:
+            match.remove()
+        self._adapter_signal_matches = []
         logger.info("HidService cleanup finished.")
 
 
     def stop(self):
-        """Stops the HID service and cleans up resources."""
+        """Requests shutdown. Non-blocking: the actual teardown runs in the GLib thread (see _shutdown)."""
         logger.info("HID Service stop requested.")
         self.stop_requested_event.set() # Signal all loops/callbacks to stop
 
         if self.mainloop and self.mainloop.is_running():
-            logger.info("Requesting GLib MainLoop to quit.")
-            # It's safer to call quit from within the mainloop's thread context if possible,
-            # or ensure callbacks check self.stop_requested_event.
-            # For an external call like this, GLib.idle_add(self.mainloop.quit) can be safer.
-            # However, direct quit is often used and usually works if called from another thread.
-            self.mainloop.quit()
+            logger.info("Scheduling HID Service shutdown in the GLib main loop.")
+            # Source removal, fd closing and D-Bus calls are not safe from another thread; marshal them over
+            GLib.idle_add(self._shutdown)
         else:
             logger.info("GLib MainLoop not running or not initialized.")
 
-        # Cleanup is now primarily in perform_cleanup(), called when mainloop exits.
-        # If perform_cleanup wasn't reached (e.g., mainloop never ran), call it here.
-        # This check is a bit complex. Simpler: main_gui_app ensures stop() is called,
-        # and run() calls perform_cleanup() in its finally block.
+    def _shutdown(self):
+        """Runs in the GLib thread: removes our sources, cleans up connections/registration, then quits the loop."""
+        if self._queue_watch_id:
+            GLib.source_remove(self._queue_watch_id)
+            self._queue_watch_id = 0
+        self.perform_cleanup()
+        self.mainloop.quit()
+        return False # One-shot idle callback
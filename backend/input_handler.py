@@ -1,14 +1,46 @@
 import evdev
 import logging
-import time
 import threading
-from select import select
-import os # For checking device paths
+import select
+import os # For checking device paths and raw event reads
+import struct
+
+try:
+    import pyudev # udev netlink monitor: devices are (re)opened the moment they appear
+except ImportError:
+    pyudev = None # Fall back to retrying every 5 seconds while no device is connected
 
 # Use the logger configured in main_gui_app.py or a specific one
 logger = logging.getLogger("InputHandler")
 
+# ecodes constants used on every event, bound once at import
+_EV_SYN = evdev.ecodes.EV_SYN
+_SYN_REPORT = evdev.ecodes.SYN_REPORT
+
+# struct input_event from linux/input.h: timeval (sec, usec), __u16 type, __u16 code, __s32 value
+_INPUT_EVENT = struct.Struct("llHHi")
+_READ_SIZE = _INPUT_EVENT.size * 64 # Up to 64 events per read(), like python-evdev
+# Reads per device per poll() round. epoll is level-triggered, so whatever is left is reported again on the next
+# poll(), after the other ready devices have had their turn: a knob burst cannot starve the buttons.
+_MAX_READS_PER_WAKE = 4
+
+_STOP_WAKEUP = object() # Poll target marking the stop fd
+_POLL_FAILED = select.EPOLLERR | select.EPOLLHUP # Set by evdev on the fd of an unplugged device
+
+def _ignore_action(count):
+    """Dispatch function for actions mapped to "none" (or to an unusable config)."""
+
+def _event_key(event_type, event_code, event_value):
+    """Packs an evdev (type, code, value) into one int: type < 2^8, code < 2^16, value as a two's-complement byte."""
+    return (event_type << 24) | (event_code << 8) | (event_value & 0xFF)
+
 class InputHandler:
+    # Long-lived and touched on every event: fixed slots instead of a per-instance __dict__
+    __slots__ = ('device_paths', 'command_queue', 'config_manager', 'devices_map', '_epoll', '_poll_targets', 'stop_event',
+                 'mappings', 'compiled', '_action_commands', 'EVENT_MAPPINGS', 'EVENT_TUPLE_TO_ACTION',
+                 'EVENT_KEY_TO_ACTION', '_relevant_codes', '_knob_axis', '_knob_accum', '_monitor', '_stop_fd', '_stop_w',
+                 '_logged_caps', '_pending')
+
     def __init__(self, device_paths, command_queue, config_manager):
         if not isinstance(device_paths, list):
             logger.error(f"Device paths should be a list, got {type(device_paths)}. Correcting to empty list.")
@@ -19,8 +51,23 @@ class InputHandler:
         self.command_queue = command_queue
         self.config_manager = config_manager
         self.devices_map = {} # Stores {fd: evdev.InputDevice}
+        self._logged_caps = set() # Device paths whose capabilities were already logged
+        # Raw epoll instead of selectors: selectors folds EPOLLERR/EPOLLHUP into EVENT_READ, and we need to see them
+        self._epoll = select.epoll() # Device fds are registered once, not passed per wait
+        self._poll_targets = {} # {fd: device, monitor or _STOP_WAKEUP} for fds registered with _epoll
+        self._monitor = self._start_hotplug_monitor() # None without pyudev
+        # Wakes the poll on stop(), so select() can block without a timeout
+        if hasattr(os, 'eventfd'): # Linux, Python 3.10+
+            self._stop_fd = self._stop_w = os.eventfd(0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)
+        else:
+            self._stop_fd, self._stop_w = os.pipe()
+        self._register(self._stop_fd, _STOP_WAKEUP)
         self.stop_event = threading.Event()
         self.mappings = {}
+        self.compiled = {} # Precompiled {action: {"type", "mod", "codes"}} from ConfigManager
+        self._action_commands = {} # {action: dispatch(count)} queueing ready-made commands, rebuilt by load_mappings
+        # Commands produced by the current read() batch; handed to the queue in one put_many (one consumer wakeup)
+        self._pending = []
 
         # --- Event Code Definitions ---
         # YOU MUST REPLACE THESE WITH ACTUAL VALUES FROM `evtest` ON YOUR CAR THING
@@ -49,51 +96,188 @@ class InputHandler:
             for action_key, event_tuples in self.EVENT_MAPPINGS.items()
             for event_tuple in event_tuples
         }
+        # Same map keyed by a packed int (see _event_key): the per-event probe hashes one int, no tuple
+        self.EVENT_KEY_TO_ACTION = {
+            _event_key(*event_tuple): action_key for event_tuple, action_key in self.EVENT_TUPLE_TO_ACTION.items()
+        }
+
+        # {event_type: frozenset(event_codes)} that appear in any mapping; everything else is dropped before the
+        # action lookup (EV_MSC scan codes, unmapped keys, ...)
+        self._relevant_codes = {
+            event_type: frozenset(code for (t, code, _value) in self.EVENT_TUPLE_TO_ACTION if t == event_type)
+            for (event_type, _code, _value) in self.EVENT_TUPLE_TO_ACTION
+        }
+        # Relative axis of the knob (taken from the knob_cw mapping); its ticks are summed per SYN_REPORT
+        self._knob_axis = self.EVENT_MAPPINGS["knob_cw"][0][:2]
+        self._knob_accum = 0
 
         self.load_mappings()
 
     def load_mappings(self):
-        self.mappings = self.config_manager.get_mappings()
+        mappings, compiled = self.config_manager.get_mappings_and_compiled()
+        if mappings is self.mappings:
+            # ConfigManager swaps in a new snapshot on every change, so the same object means nothing changed
+            logger.debug("InputHandler mappings unchanged, not rebuilding.")
+            return
+        action_commands = self._build_action_commands(mappings, compiled)
+        # Only record the snapshot once its dispatch table exists: a failed build is retried on the next reload
+        self.mappings, self.compiled, self._action_commands = mappings, compiled, action_commands
         logger.info(f"InputHandler mappings reloaded: {len(self.mappings)} actions configured.")
-        logger.debug(f"Current mappings: {self.mappings}")
+        logger.debug("Current mappings: %s", self.mappings) # Lazy: the whole config is only formatted at DEBUG
+
+    def _build_action_commands(self, mappings, compiled_mappings):
+        """Builds one dispatch function per mapped action, so handling an event is a lookup plus one call."""
+        put = self._pending.append # Flushed to the command queue by _flush_pending after each read batch
+        action_commands = {}
+        for action_key, command_config in mappings.items():
+            command_type = command_config.get("type")
+            keys_to_act = command_config.get("keys", [])
+
+            if not keys_to_act and command_type != "none": # "none" type doesn't need keys
+                logger.warning(f"No keys defined for action '{action_key}' with type '{command_type}'. It will be ignored.")
+                action_commands[action_key] = _ignore_action
+                continue
 
+            # Resolved HID codes travel with the command so HidService skips the key name lookups.
+            # The dicts are shared between puts; the consumer only reads them.
+            compiled = compiled_mappings[action_key]
+            mod_mask, key_codes = compiled["mod"], compiled["codes"]
+
+            if command_type == "key_press":
+                command = {'type': 'press', 'keys': keys_to_act, 'mod': mod_mask, 'codes': key_codes}
+                action_commands[action_key] = lambda count, command=command: put(command)
+            elif command_type == "key_release":
+                command = {'type': 'release', 'keys': keys_to_act, 'mod': mod_mask, 'codes': key_codes}
+                action_commands[action_key] = lambda count, command=command: put(command)
+            elif command_type == "key_tap":
+                # One command for the whole tap (or run of taps); HidService sends a press and a release report for each
+                command = {'type': 'tap', 'keys': keys_to_act, 'mod': mod_mask, 'codes': key_codes,
+                           'report': compiled["report"], 'count': 1}
+                # Only knob bursts (count > 1) pay for a copy
+                action_commands[action_key] = lambda count, command=command: put(command if count == 1 else dict(command, count=count))
+            elif command_type == "none":
+                action_commands[action_key] = _ignore_action
+            else:
+                logger.warning(f"Unknown command type '{command_type}' for action '{action_key}'. It will be ignored.")
+                action_commands[action_key] = _ignore_action
+        return action_commands
 
     def _connect_devices(self):
         # Close any existing connections before attempting to reconnect
         for fd, dev in list(self.devices_map.items()):
-            try:
-                logger.info(f"Closing stale connection to {dev.path}")
-                dev.close()
-            except Exception as e:
-                logger.error(f"Error closing stale device {dev.path}: {e}")
-            del self.devices_map[fd]
+            logger.info(f"Closing stale connection to {dev.path}")
+            self._remove_device(fd)
 
         if not self.device_paths:
             logger.warning("No device paths provided to InputHandler.")
             return False
 
         for path in self.device_paths:
-            if not os.path.exists(path):
-                logger.warning(f"Input device path does not exist: {path}")
-                continue
-            if not os.access(path, os.R_OK):
-                logger.warning(f"Input device path not readable (permissions?): {path}")
+            self._open_device(path)
+        return bool(self.devices_map)
+
+    def _open_device(self, path):
+        """Opens one input device and adds it to the poll set. Returns True on success."""
+        if not os.path.exists(path):
+            logger.warning(f"Input device path does not exist: {path}")
+            return False
+        if not os.access(path, os.R_OK):
+            logger.warning(f"Input device path not readable (permissions?): {path}")
+            return False
+        try:
+            dev = evdev.InputDevice(path)
+            # Grab device to ensure exclusive access if needed (be careful with this)
+            # try:
+            #     dev.grab() # This can prevent other applications (like desktop environment) from seeing events
+            #     logger.info(f"Grabbed device: {dev.name} ({path})")
+            # except IOError as e:
+            #     logger.warning(f"Could not grab device {dev.name}: {e}. It might be in use or permissions issue.")
+
+            self._register(dev.fd, dev)
+            self.devices_map[dev.fd] = dev
+            logger.info(f"Successfully connected to input device: {dev.name} ({path}), fd: {dev.fd}")
+            # capabilities(verbose=True) walks every ioctl result through evdev.ecodes: only at DEBUG, once per path
+            if path not in self._logged_caps and logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"Device capabilities: {dev.capabilities(verbose=True)}")
+                self._logged_caps.add(path)
+            return True
+        except Exception as e:
+            logger.error(f"Failed to connect to input device {path}: {e}")
+            return False
+
+    def _start_hotplug_monitor(self):
+        """Watches udev for input device add/remove and registers the monitor fd for polling."""
+        if pyudev is None:
+            logger.info("pyudev not available; input devices will be re-checked every 5 seconds while disconnected.")
+            return None
+        try:
+            monitor = pyudev.Monitor.from_netlink(pyudev.Context())
+            monitor.filter_by('input')
+            monitor.start()
+            self._register(monitor.fileno(), monitor)
+            return monitor
+        except Exception as e:
+            logger.warning(f"Could not start udev monitor ({e}); falling back to periodic reconnects.")
+            return None
+
+    def _stop_hotplug_monitor(self):
+        """Unregisters the udev monitor and drops it; pyudev has no close(), its netlink socket is
+           released (udev_monitor_unref) when the last reference goes away.
+        """
+        monitor, self._monitor = self._monitor, None
+        if monitor is None:
+            return
+        fd = monitor.fileno()
+        if self._poll_targets.pop(fd, None) is not None:
+            try:
+                self._epoll.unregister(fd)
+            except OSError:
+                pass
+
+    def _handle_hotplug(self):
+        """Opens configured devices that just appeared and drops ones that were removed."""
+        # Configured paths may be symlinks (e.g. /dev/input/by-path/...); udev reports /dev/input/eventN
+        wanted = {os.path.realpath(path): path for path in self.device_paths}
+        while True:
+            udev_device = self._monitor.poll(timeout=0)
+            if udev_device is None:
+                return
+            path = wanted.get(udev_device.device_node)
+            if path is None:
                 continue
+            if udev_device.action == 'add':
+                if not any(dev.path == path for dev in self.devices_map.values()):
+                    logger.info(f"Input device {path} appeared, connecting.")
+                    self._open_device(path)
+            elif udev_device.action == 'remove':
+                for fd, dev in list(self.devices_map.items()):
+                    if dev.path == path:
+                        logger.info(f"Input device {path} removed.")
+                        self._remove_device(fd)
+
+    def _register(self, fd, target):
+        """Polls fd for input; errors and hangups are always reported by epoll.
+           Level-triggered on purpose: the drain in run() stops at a short read, so a drained fd is not reported
+           again anyway, and a device cut off by _MAX_READS_PER_WAKE must be reported again (with EPOLLET it would
+           wedge until its next event).
+        """
+        self._epoll.register(fd, select.EPOLLIN | select.EPOLLERR | select.EPOLLHUP)
+        self._poll_targets[fd] = target
+
+    def _remove_device(self, fd):
+        """Unregisters, closes and forgets the device on fd."""
+        dev = self.devices_map.pop(fd, None)
+        if self._poll_targets.pop(fd, None) is not None:
+            try:
+                self._epoll.unregister(fd)
+            except OSError: # fd already invalid
+                pass
+        if dev:
             try:
-                dev = evdev.InputDevice(path)
-                # Grab device to ensure exclusive access if needed (be careful with this)
-                # try:
-                #     dev.grab() # This can prevent other applications (like desktop environment) from seeing events
-                #     logger.info(f"Grabbed device: {dev.name} ({path})")
-                # except IOError as e:
-                #     logger.warning(f"Could not grab device {dev.name}: {e}. It might be in use or permissions issue.")
-
-                self.devices_map[dev.fd] = dev
-                logger.info(f"Successfully connected to input device: {dev.name} ({path}), fd: {dev.fd}")
-                logger.info(f"Device capabilities: {dev.capabilities(verbose=True)}")
+                dev.close()
             except Exception as e:
-                logger.error(f"Failed to connect to input device {path}: {e}")
-        return bool(self.devices_map)
+                logger.error(f"Error closing device {dev.path}: {e}")
+        return dev
 
     def run(self):
         logger.info("Input Handler starting...")
@@ -101,116 +285,147 @@ class InputHandler:
             logger.warning("Initial connection to input devices failed. Will retry.")
 
         while not self.stop_event.is_set():
-            if not self.devices_map:
+            if not self.devices_map and self._monitor is None: # With the udev monitor, arrivals wake the poll
                 logger.warning("No input devices connected. Retrying connection in 5 seconds...")
-                time.sleep(5)
+                if self.stop_event.wait(5): # Returns early on stop()
+                    break
                 if not self._connect_devices():
                     continue # Skip to next loop iteration if still no devices
 
             try:
-                fds_to_watch = list(self.devices_map.keys())
-                if not fds_to_watch: # Should be caught by the self.devices_map check above
-                    time.sleep(1)
-                    continue
-
-                # select() call: arguments are (read_fds, write_fds, error_fds, timeout_in_seconds)
-                r, w, x = select(fds_to_watch, [], fds_to_watch, 1.0) # Timeout 1 second
+                # Only ready fds are returned. No timeout: stop() and (with pyudev) hotplug wake the poll
+                # through their own fds.
+                ready = self._epoll.poll()
 
                 if self.stop_event.is_set(): break
 
-                for fd in r: # Readable file descriptors
-                    device = self.devices_map.get(fd)
-                    if not device: continue # Should not happen if fds_to_watch is from keys
+                for fd, mask in ready:
+                    device = self._poll_targets.get(fd)
+                    if device is _STOP_WAKEUP:
+                        continue # stop_event is already set; the loop condition ends the run
+                    if device is self._monitor:
+                        self._handle_hotplug()
+                        continue
+                    if fd not in self.devices_map: continue # Removed earlier in this batch
+                    if mask & _POLL_FAILED:
+                        # Unplugged (or failed): drop it without a read() that would only raise ENODEV
+                        logger.warning(f"Input device {device.path} (fd {fd}) hung up. Disconnecting device.")
+                        self._remove_device(fd)
+                        continue
 
                     try:
-                        for event in device.read():
-                            self.process_event(event, device.path)
+                        # Raw input_event records straight from the fd: no InputEvent object per event.
+                        # Drain until the kernel buffer is empty (or the per-round cap), so a fast knob burst is
+                        # handled in few wake-ups.
+                        device_path = device.path
+                        for _ in range(_MAX_READS_PER_WAKE):
+                            data = os.read(fd, _READ_SIZE)
+                            if not data:
+                                raise OSError("Input device returned EOF")
+                            try:
+                                for _sec, _usec, event_type, event_code, event_value in _INPUT_EVENT.iter_unpack(data):
+                                    self.process_event(event_type, event_code, event_value, device_path)
+                            finally:
+                                self._flush_pending()
+                            if len(data) < _READ_SIZE:
+                                break # Short read: nothing left, skip the extra read() that would hit EAGAIN
                     except BlockingIOError:
-                        # No events available to read (shouldn't happen often with select)
+                        # Kernel event buffer is empty (the normal way out of the drain loop)
                         pass
-                    except OSError as e: # This can happen if device is disconnected
+                    except OSError as e: # Device failed between poll() and read()
                         logger.error(f"OSError reading from device {device.path} (fd {fd}): {e}. Disconnecting device.")
-                        device.close()
-                        del self.devices_map[fd]
+                        self._remove_device(fd)
                         # No need to explicitly reconnect here, the loop will try if devices_map becomes empty
-                        break # Break from processing events for this device
-
-                for fd in x: # File descriptors with errors
-                     device = self.devices_map.get(fd)
-                     logger.error(f"Error on file descriptor for device {device.path if device else fd}. Disconnecting.")
-                     if device:
-                         device.close()
-                         del self.devices_map[fd]
-
 
             except Exception as e:
                 logger.exception(f"Unhandled error in input loop: {e}")
                 # Attempt to recover: Clear all devices to force full reconnect attempt
-                for dev_fd, dev_obj in list(self.devices_map.items()):
-                    try: dev_obj.close()
-                    except: pass
-                self.devices_map.clear()
-                time.sleep(5) # Wait a bit before retrying full connection
+                for dev_fd in list(self.devices_map):
+                    self._remove_device(dev_fd)
+                if self.stop_event.wait(5): # Wait a bit before retrying full connection; returns early on stop()
+                    break
+                if self._monitor is not None: # No timed retry with the monitor: reopen the devices still present now
+                    self._connect_devices()
 
         logger.info("Input Handler stopping...")
-        for fd, dev in self.devices_map.items():
-            try:
-                # dev.ungrab() # If grabbed
-                dev.close()
-                logger.info(f"Closed device {dev.path}")
-            except Exception as e:
-                logger.error(f"Error closing device {dev.path}: {e}")
-        self.devices_map.clear()
+        for fd in list(self.devices_map):
+            # dev.ungrab() # If grabbed
+            dev = self._remove_device(fd)
+            logger.info(f"Closed device {dev.path}")
+        self._stop_hotplug_monitor()
+        self._close_stop_fds()
+        self._epoll.close()
+        self._poll_targets.clear()
         logger.info("Input Handler stopped.")
 
+    def _close_stop_fds(self):
+        """Closes the stop wakeup fd(s); a later stop() then only sets the event."""
+        stop_fd, stop_w = self._stop_fd, self._stop_w
+        self._stop_fd = self._stop_w = -1
+        for fd in {stop_fd, stop_w}: # One eventfd serves as both ends
+            if fd != -1:
+                os.close(fd)
+
 
     def stop(self):
         logger.info("Input Handler stop requested.")
         self.stop_event.set()
+        stop_w = self._stop_w
+        if stop_w == -1: # run() already exited and closed it
+            return
+        try:
+            os.write(stop_w, (1).to_bytes(8, "little")) # eventfd counter increment (or a byte for the pipe)
+        except OSError: # Closed by run() between the check and the write, or the pipe is full
+            pass
+
+    def process_event(self, event_type, event_code, event_value, device_path):
+        # logger.debug(f"Raw event from {device_path}: type={event_type}, code={event_code}, value={event_value}")
+        # Hot path (every evdev event): fields arrive unpacked, ecodes constants are module globals
+
+        if event_type == _EV_SYN:
+            # SYN_REPORT indicates end of a packet of events: emit the knob ticks accumulated within it as one command.
+            # logger.debug(f"Sync event from {device_path}: SYN_REPORT code={event_code} value={event_value}")
+            delta = self._knob_accum
+            if delta and event_code == _SYN_REPORT:
+                self._knob_accum = 0
+                knob_type, knob_code = self._knob_axis
+                direction = 1 if delta > 0 else -1
+                action_key = self.EVENT_KEY_TO_ACTION.get(_event_key(knob_type, knob_code, direction))
+                if action_key:
+                    self._dispatch_action(action_key, device_path, (knob_type, knob_code, direction), count=abs(delta))
+            return
 
-    def process_event(self, event, device_path):
-        # logger.debug(f"Raw event from {device_path}: type={event.type}, code={event.code}, value={event.value}, sec={event.sec}, usec={event.usec}")
+        relevant_codes = self._relevant_codes.get(event_type)
+        if relevant_codes is None or event_code not in relevant_codes:
+            return # No mapping can match: skip the lookup
 
-        if event.type == evdev.ecodes.EV_SYN:
-            # SYN_REPORT indicates end of a packet of events.
-            # For simple key/knob events, often not needed for logic unless dealing with complex sequences.
-            # logger.debug(f"Sync event from {device_path}: SYN_REPORT code={event.code} value={event.value}")
+        knob_type, knob_code = self._knob_axis
+        if event_code == knob_code and event_type == knob_type:
+            # Fast spins report several detents per packet; sum them and dispatch once at SYN_REPORT
+            self._knob_accum += event_value
             return
 
-        event_tuple = (event.type, event.code, event.value)
-        # logger.debug(f"Processed event tuple: {event_tuple} from {device_path}")
-
-        action_key = self.EVENT_TUPLE_TO_ACTION.get(event_tuple)
+        action_key = self.EVENT_KEY_TO_ACTION.get((event_type << 24) | (event_code << 8) | (event_value & 0xFF)) # _event_key, inlined
 
         if action_key:
-            logger.info(f"Detected action: '{action_key}' from device {device_path} (event: {event_tuple})")
-            if action_key in self.mappings:
-                command_config = self.mappings[action_key]
-                logger.debug(f"Mapping found for '{action_key}': {command_config}")
-
-                command_type = command_config.get("type")
-                keys_to_act = command_config.get("keys", [])
-
-                if not keys_to_act and command_type != "none": # "none" type doesn't need keys
-                    logger.warning(f"No keys defined for action '{action_key}' with type '{command_type}'. Skipping.")
-                    return
-
-                if command_type == "key_press":
-                    self.command_queue.put({'type': 'press', 'keys': keys_to_act})
-                elif command_type == "key_release":
-                     self.command_queue.put({'type': 'release', 'keys': keys_to_act})
-                elif command_type == "key_tap":
-                     self.command_queue.put({'type': 'press', 'keys': keys_to_act})
-                     # A very small delay might be necessary for some OS/apps to register tap correctly
-                     # However, HID service usually sends release immediately after press for tap.
-                     # Forcing a slight delay here if problems arise:
-                     # time.sleep(0.01) # 10ms, use with caution, can block this handler
-                     self.command_queue.put({'type': 'release', 'keys': keys_to_act})
-                elif command_type == "none":
-                    logger.debug(f"Action '{action_key}' is configured to 'none'. No command sent.")
-                else:
-                    logger.warning(f"Unknown command type '{command_type}' for action '{action_key}'")
-            else:
-                 logger.warning(f"No mapping defined in config file for detected action: '{action_key}'")
+            # The tuple is only built for matched events, for the log line
+            self._dispatch_action(action_key, device_path, (event_type, event_code, event_value))
         # else:
-            # logger.debug(f"No action key defined for event tuple: {event_tuple}")
+            # logger.debug(f"No action key defined for event tuple: {(event_type, event_code, event_value)}")
+
+    def _flush_pending(self):
+        """Queues the commands collected from one read batch with a single wakeup of the HID thread."""
+        pending = self._pending
+        if pending:
+            self.command_queue.put_many(pending)
+            pending.clear()
+
+    def _dispatch_action(self, action_key, device_path, event_tuple, count=1):
+        """Queues the HID command(s) mapped to action_key; count > 1 repeats a tap (coalesced knob detents)."""
+        # %-style: formatted by logging only if the record is actually emitted (this runs on every mapped event)
+        logger.info("Detected action: '%s' x%d from device %s (event: %s)", action_key, count, device_path, event_tuple)
+        dispatch = self._action_commands.get(action_key)
+        if dispatch is None:
+            logger.warning(f"No mapping defined in config file for detected action: '{action_key}'")
+            return
+        dispatch(count)
@@ -2,103 +2,157 @@
 # Source/Inspiration: https://github.com/micropython/micropython/blob/master/drivers/bluetooth/ble_hid_keyboard.py
 # And Linux input event codes: /usr/include/linux/input-event-codes.h
 
+import functools
+from types import MappingProxyType
+
+# Modifier masks (byte 0)
+MOD_NONE = 0x00
+MOD_LEFT_CTRL = 0x01
+MOD_LEFT_SHIFT = 0x02
+MOD_LEFT_ALT = 0x04
+MOD_LEFT_GUI = 0x08  # Windows/Command Key
+MOD_RIGHT_CTRL = 0x10
+MOD_RIGHT_SHIFT = 0x20
+MOD_RIGHT_ALT = 0x40 # AltGr
+MOD_RIGHT_GUI = 0x80
+
+# HID Usage IDs (bytes 2-7)
+_NAME_TO_CODE = {
+    # Letters
+    "A": (MOD_NONE, 0x04), "B": (MOD_NONE, 0x05), "C": (MOD_NONE, 0x06),
+    "D": (MOD_NONE, 0x07), "E": (MOD_NONE, 0x08), "F": (MOD_NONE, 0x09),
+    "G": (MOD_NONE, 0x0A), "H": (MOD_NONE, 0x0B), "I": (MOD_NONE, 0x0C),
+    "J": (MOD_NONE, 0x0D), "K": (MOD_NONE, 0x0E), "L": (MOD_NONE, 0x0F),
+    "M": (MOD_NONE, 0x10), "N": (MOD_NONE, 0x11), "O": (MOD_NONE, 0x12),
+    "P": (MOD_NONE, 0x13), "Q": (MOD_NONE, 0x14), "R": (MOD_NONE, 0x15),
+    "S": (MOD_NONE, 0x16), "T": (MOD_NONE, 0x17), "U": (MOD_NONE, 0x18),
+    "V": (MOD_NONE, 0x19), "W": (MOD_NONE, 0x1A), "X": (MOD_NONE, 0x1B),
+    "Y": (MOD_NONE, 0x1C), "Z": (MOD_NONE, 0x1D),
+    # Numbers
+    "1": (MOD_NONE, 0x1E), "2": (MOD_NONE, 0x1F), "3": (MOD_NONE, 0x20),
+    "4": (MOD_NONE, 0x21), "5": (MOD_NONE, 0x22), "6": (MOD_NONE, 0x23),
+    "7": (MOD_NONE, 0x24), "8": (MOD_NONE, 0x25), "9": (MOD_NONE, 0x26),
+    "0": (MOD_NONE, 0x27),
+    # Punctuation & Symbols
+    "ENTER": (MOD_NONE, 0x28), "ESCAPE": (MOD_NONE, 0x29), "BACKSPACE": (MOD_NONE, 0x2A),
+    "TAB": (MOD_NONE, 0x2B), "SPACE": (MOD_NONE, 0x2C),
+    "MINUS": (MOD_NONE, 0x2D), "EQUAL": (MOD_NONE, 0x2E),
+    "LEFT_BRACKET": (MOD_NONE, 0x2F), "RIGHT_BRACKET": (MOD_NONE, 0x30),
+    "BACKSLASH": (MOD_NONE, 0x31), "HASH": (MOD_NONE, 0x32), # Varies by layout (#~)
+    "SEMICOLON": (MOD_NONE, 0x33), "QUOTE": (MOD_NONE, 0x34), # Apostrophe
+    "GRAVE": (MOD_NONE, 0x35), # Backtick `~`
+    "COMMA": (MOD_NONE, 0x36), "PERIOD": (MOD_NONE, 0x37), "SLASH": (MOD_NONE, 0x38),
+    # Function Keys
+    "F1": (MOD_NONE, 0x3A), "F2": (MOD_NONE, 0x3B), "F3": (MOD_NONE, 0x3C),
+    "F4": (MOD_NONE, 0x3D), "F5": (MOD_NONE, 0x3E), "F6": (MOD_NONE, 0x3F),
+    "F7": (MOD_NONE, 0x40), "F8": (MOD_NONE, 0x41), "F9": (MOD_NONE, 0x42),
+    "F10": (MOD_NONE, 0x43), "F11": (MOD_NONE, 0x44), "F12": (MOD_NONE, 0x45),
+    # Control Keys
+    "CAPS_LOCK": (MOD_NONE, 0x39), "PRINT_SCREEN": (MOD_NONE, 0x46),
+    "SCROLL_LOCK": (MOD_NONE, 0x47), "PAUSE": (MOD_NONE, 0x48),
+    "INSERT": (MOD_NONE, 0x49), "HOME": (MOD_NONE, 0x4A), "PAGE_UP": (MOD_NONE, 0x4B),
+    "DELETE": (MOD_NONE, 0x4C), "END": (MOD_NONE, 0x4D), "PAGE_DOWN": (MOD_NONE, 0x4E),
+    "RIGHT_ARROW": (MOD_NONE, 0x4F), "LEFT_ARROW": (MOD_NONE, 0x50),
+    "DOWN_ARROW": (MOD_NONE, 0x51), "UP_ARROW": (MOD_NONE, 0x52),
+    # Keypad
+    "KP_NUMLOCK": (MOD_NONE, 0x53), "KP_SLASH": (MOD_NONE, 0x54),
+    "KP_ASTERISK": (MOD_NONE, 0x55), "KP_MINUS": (MOD_NONE, 0x56),
+    "KP_PLUS": (MOD_NONE, 0x57), "KP_ENTER": (MOD_NONE, 0x58),
+    "KP_1": (MOD_NONE, 0x59), "KP_2": (MOD_NONE, 0x5A), "KP_3": (MOD_NONE, 0x5B),
+    "KP_4": (MOD_NONE, 0x5C), "KP_5": (MOD_NONE, 0x5D), "KP_6": (MOD_NONE, 0x5E),
+    "KP_7": (MOD_NONE, 0x5F), "KP_8": (MOD_NONE, 0x60), "KP_9": (MOD_NONE, 0x61),
+    "KP_0": (MOD_NONE, 0x62), "KP_PERIOD": (MOD_NONE, 0x63),
+    # Modifiers (represent these as separate keys if needed, or use MOD flags for combinations)
+    "LEFT_CTRL": (MOD_LEFT_CTRL, 0x00), "LEFT_SHIFT": (MOD_LEFT_SHIFT, 0x00),
+    "LEFT_ALT": (MOD_LEFT_ALT, 0x00), "LEFT_GUI": (MOD_LEFT_GUI, 0x00), # Windows/Super/Command
+    "RIGHT_CTRL": (MOD_RIGHT_CTRL, 0x00), "RIGHT_SHIFT": (MOD_RIGHT_SHIFT, 0x00),
+    "RIGHT_ALT": (MOD_RIGHT_ALT, 0x00), "RIGHT_GUI": (MOD_RIGHT_GUI, 0x00),
+    # Media Keys (Consumer Page 0x0C) - These require a different HID report descriptor and handling.
+    # For simplicity here, they are mapped to regular keycodes that MIGHT be interpreted by some OSes
+    # as media keys if suitable software (or desktop environment) is running.
+    # True media key support requires a Consumer Control HID report.
+    # The current hid_service.py uses a standard keyboard report descriptor.
+    "VOLUME_UP": (MOD_NONE, 0x80),   # Placeholder - often F15 or custom. True HID: Consumer Page, Usage ID 0xE9
+    "VOLUME_DOWN": (MOD_NONE, 0x81), # Placeholder - often F14 or custom. True HID: Consumer Page, Usage ID 0xEA
+    "MUTE": (MOD_NONE, 0x7F),        # Placeholder - often F13 or custom. True HID: Consumer Page, Usage ID 0xE2
+    "PLAY_PAUSE": (MOD_NONE, 0xCD),  # Keyboard Play/Pause. True HID: Consumer Page, Usage ID 0xCD
+    "NEXT_TRACK": (MOD_NONE, 0xB5),  # Keyboard Next Track. True HID: Consumer Page, Usage ID 0xB5
+    "PREV_TRACK": (MOD_NONE, 0xB6),  # Keyboard Previous Track. True HID: Consumer Page, Usage ID 0xB6
+    "STOP_MEDIA": (MOD_NONE, 0xB7),  # Keyboard Stop. True HID: Consumer Page, Usage ID 0xB7
+    # Placeholder for None/Empty Action
+    "NONE": (MOD_NONE, 0x00), # Represents no key press
+}
+
+# Map Usage ID back to name if needed (e.g., for display)
+# This is a simplified reverse map and won't perfectly distinguish all keys if codes overlap (e.g. 0x00 for modifiers)
+_CODE_TO_NAME = {v[1]: k for k, v in _NAME_TO_CODE.items() if v[1] != 0x00} # Exclude 0x00 keys for direct lookup
+# Add modifiers explicitly if you want to look them up by a "fake" keycode (not standard)
+# For display purposes, it's better to check the modifier byte directly.
+# _CODE_TO_NAME[0xE0] = "LEFT_CTRL" # Example, not a real keycode for Left Ctrl alone in report byte 2-7
+
+# Same reverse map as a 256-entry table indexed by the (one-byte) Usage ID: get_name is an index, not a hash lookup
+_CODE_TO_NAME_TABLE = ["UNKNOWN"] * 256
+for _code, _name in _CODE_TO_NAME.items():
+    _CODE_TO_NAME_TABLE[_code] = _name
+_CODE_TO_NAME_TABLE = tuple(_CODE_TO_NAME_TABLE)
+del _code, _name
+
+# Modifier bit index (0-7, byte 0 of the report) -> name
+_MODIFIER_BIT_NAMES = tuple(
+    next(name for name, (mod, code) in _NAME_TO_CODE.items() if mod == 1 << bit and code == 0x00)
+    for bit in range(8)
+)
+
+# Read-only views shared by every KeycodeMap; the tables are built once, at import
+NAME_TO_CODE = MappingProxyType(_NAME_TO_CODE)
+CODE_TO_NAME = MappingProxyType(_CODE_TO_NAME)
+# Key names in display order, sorted once for the GUI key picker and the web API
+AVAILABLE_KEY_NAMES = tuple(sorted(_NAME_TO_CODE))
+
+
+@functools.lru_cache(maxsize=256) # Name -> codes is static; bounded since names can come from user config
+def get_codes(key_name):
+    """Returns (modifier_mask, key_code) tuple for a given key name, in any case.
+       Cached per name as given, so repeat lookups skip the .upper() as well as the table probe.
+    """
+    # For modifier keys like "LEFT_CTRL", the key_code part is 0x00 as they only set bits in the modifier byte.
+    return _NAME_TO_CODE.get(key_name.upper(), (MOD_NONE, 0x00)) # Return (MOD_NONE, 0x00) for "NONE" or unknown
+
+
 class KeycodeMap:
     """Maps key names to HID Usage IDs and Modifier masks."""
-    def __init__(self):
-        # Modifier masks (byte 0)
-        self.MOD_NONE = 0x00
-        self.MOD_LEFT_CTRL = 0x01
-        self.MOD_LEFT_SHIFT = 0x02
-        self.MOD_LEFT_ALT = 0x04
-        self.MOD_LEFT_GUI = 0x08  # Windows/Command Key
-        self.MOD_RIGHT_CTRL = 0x10
-        self.MOD_RIGHT_SHIFT = 0x20
-        self.MOD_RIGHT_ALT = 0x40 # AltGr
-        self.MOD_RIGHT_GUI = 0x80
-
-        # HID Usage IDs (bytes 2-7)
-        self.NAME_TO_CODE = {
-            # Letters
-            "A": (self.MOD_NONE, 0x04), "B": (self.MOD_NONE, 0x05), "C": (self.MOD_NONE, 0x06),
-            "D": (self.MOD_NONE, 0x07), "E": (self.MOD_NONE, 0x08), "F": (self.MOD_NONE, 0x09),
-            "G": (self.MOD_NONE, 0x0A), "H": (self.MOD_NONE, 0x0B), "I": (self.MOD_NONE, 0x0C),
-            "J": (self.MOD_NONE, 0x0D), "K": (self.MOD_NONE, 0x0E), "L": (self.MOD_NONE, 0x0F),
-            "M": (self.MOD_NONE, 0x10), "N": (self.MOD_NONE, 0x11), "O": (self.MOD_NONE, 0x12),
-            "P": (self.MOD_NONE, 0x13), "Q": (self.MOD_NONE, 0x14), "R": (self.MOD_NONE, 0x15),
-            "S": (self.MOD_NONE, 0x16), "T": (self.MOD_NONE, 0x17), "U": (self.MOD_NONE, 0x18),
-            "V": (self.MOD_NONE, 0x19), "W": (self.MOD_NONE, 0x1A), "X": (self.MOD_NONE, 0x1B),
-            "Y": (self.MOD_NONE, 0x1C), "Z": (self.MOD_NONE, 0x1D),
-            # Numbers
-            "1": (self.MOD_NONE, 0x1E), "2": (self.MOD_NONE, 0x1F), "3": (self.MOD_NONE, 0x20),
-            "4": (self.MOD_NONE, 0x21), "5": (self.MOD_NONE, 0x22), "6": (self.MOD_NONE, 0x23),
-            "7": (self.MOD_NONE, 0x24), "8": (self.MOD_NONE, 0x25), "9": (self.MOD_NONE, 0x26),
-            "0": (self.MOD_NONE, 0x27),
-            # Punctuation & Symbols
-            "ENTER": (self.MOD_NONE, 0x28), "ESCAPE": (self.MOD_NONE, 0x29), "BACKSPACE": (self.MOD_NONE, 0x2A),
-            "TAB": (self.MOD_NONE, 0x2B), "SPACE": (self.MOD_NONE, 0x2C),
-            "MINUS": (self.MOD_NONE, 0x2D), "EQUAL": (self.MOD_NONE, 0x2E),
-            "LEFT_BRACKET": (self.MOD_NONE, 0x2F), "RIGHT_BRACKET": (self.MOD_NONE, 0x30),
-            "BACKSLASH": (self.MOD_NONE, 0x31), "HASH": (self.MOD_NONE, 0x32), # Varies by layout (#~)
-            "SEMICOLON": (self.MOD_NONE, 0x33), "QUOTE": (self.MOD_NONE, 0x34), # Apostrophe
-            "GRAVE": (self.MOD_NONE, 0x35), # Backtick `~`
-            "COMMA": (self.MOD_NONE, 0x36), "PERIOD": (self.MOD_NONE, 0x37), "SLASH": (self.MOD_NONE, 0x38),
-            # Function Keys
-            "F1": (self.MOD_NONE, 0x3A), "F2": (self.MOD_NONE, 0x3B), "F3": (self.MOD_NONE, 0x3C),
-            "F4": (self.MOD_NONE, 0x3D), "F5": (self.MOD_NONE, 0x3E), "F6": (self.MOD_NONE, 0x3F),
-            "F7": (self.MOD_NONE, 0x40), "F8": (self.MOD_NONE, 0x41), "F9": (self.MOD_NONE, 0x42),
-            "F10": (self.MOD_NONE, 0x43), "F11": (self.MOD_NONE, 0x44), "F12": (self.MOD_NONE, 0x45),
-            # Control Keys
-            "CAPS_LOCK": (self.MOD_NONE, 0x39), "PRINT_SCREEN": (self.MOD_NONE, 0x46),
-            "SCROLL_LOCK": (self.MOD_NONE, 0x47), "PAUSE": (self.MOD_NONE, 0x48),
-            "INSERT": (self.MOD_NONE, 0x49), "HOME": (self.MOD_NONE, 0x4A), "PAGE_UP": (self.MOD_NONE, 0x4B),
-            "DELETE": (self.MOD_NONE, 0x4C), "END": (self.MOD_NONE, 0x4D), "PAGE_DOWN": (self.MOD_NONE, 0x4E),
-            "RIGHT_ARROW": (self.MOD_NONE, 0x4F), "LEFT_ARROW": (self.MOD_NONE, 0x50),
-            "DOWN_ARROW": (self.MOD_NONE, 0x51), "UP_ARROW": (self.MOD_NONE, 0x52),
-            # Keypad
-            "KP_NUMLOCK": (self.MOD_NONE, 0x53), "KP_SLASH": (self.MOD_NONE, 0x54),
-            "KP_ASTERISK": (self.MOD_NONE, 0x55), "KP_MINUS": (self.MOD_NONE, 0x56),
-            "KP_PLUS": (self.MOD_NONE, 0x57), "KP_ENTER": (self.MOD_NONE, 0x58),
-            "KP_1": (self.MOD_NONE, 0x59), "KP_2": (self.MOD_NONE, 0x5A), "KP_3": (self.MOD_NONE, 0x5B),
-            "KP_4": (self.MOD_NONE, 0x5C), "KP_5": (self.MOD_NONE, 0x5D), "KP_6": (self.MOD_NONE, 0x5E),
-            "KP_7": (self.MOD_NONE, 0x5F), "KP_8": (self.MOD_NONE, 0x60), "KP_9": (self.MOD_NONE, 0x61),
-            "KP_0": (self.MOD_NONE, 0x62), "KP_PERIOD": (self.MOD_NONE, 0x63),
-            # Modifiers (represent these as separate keys if needed, or use MOD flags for combinations)
-            "LEFT_CTRL": (self.MOD_LEFT_CTRL, 0x00), "LEFT_SHIFT": (self.MOD_LEFT_SHIFT, 0x00),
-            "LEFT_ALT": (self.MOD_LEFT_ALT, 0x00), "LEFT_GUI": (self.MOD_LEFT_GUI, 0x00), # Windows/Super/Command
-            "RIGHT_CTRL": (self.MOD_RIGHT_CTRL, 0x00), "RIGHT_SHIFT": (self.MOD_RIGHT_SHIFT, 0x00),
-            "RIGHT_ALT": (self.MOD_RIGHT_ALT, 0x00), "RIGHT_GUI": (self.MOD_RIGHT_GUI, 0x00),
-            # Media Keys (Consumer Page 0x0C) - These require a different HID report descriptor and handling.
-            # For simplicity here, they are mapped to regular keycodes that MIGHT be interpreted by some OSes
-            # as media keys if suitable software (or desktop environment) is running.
-            # True media key support requires a Consumer Control HID report.
-            # The current hid_service.py uses a standard keyboard report descriptor.
-            "VOLUME_UP": (self.MOD_NONE, 0x80),   # Placeholder - often F15 or custom. True HID: Consumer Page, Usage ID 0xE9
-            "VOLUME_DOWN": (self.MOD_NONE, 0x81), # Placeholder - often F14 or custom. True HID: Consumer Page, Usage ID 0xEA
-            "MUTE": (self.MOD_NONE, 0x7F),        # Placeholder - often F13 or custom. True HID: Consumer Page, Usage ID 0xE2
-            "PLAY_PAUSE": (self.MOD_NONE, 0xCD),  # Keyboard Play/Pause. True HID: Consumer Page, Usage ID 0xCD
-            "NEXT_TRACK": (self.MOD_NONE, 0xB5),  # Keyboard Next Track. True HID: Consumer Page, Usage ID 0xB5
-            "PREV_TRACK": (self.MOD_NONE, 0xB6),  # Keyboard Previous Track. True HID: Consumer Page, Usage ID 0xB6
-            "STOP_MEDIA": (self.MOD_NONE, 0xB7),  # Keyboard Stop. True HID: Consumer Page, Usage ID 0xB7
-            # Placeholder for None/Empty Action
-            "NONE": (self.MOD_NONE, 0x00), # Represents no key press
-        }
-
-        # Map Usage ID back to name if needed (e.g., for display)
-        # This is a simplified reverse map and won't perfectly distinguish all keys if codes overlap (e.g. 0x00 for modifiers)
-        self.CODE_TO_NAME = {v[1]: k for k, v in self.NAME_TO_CODE.items() if v[1] != 0x00} # Exclude 0x00 keys for direct lookup
-        # Add modifiers explicitly if you want to look them up by a "fake" keycode (not standard)
-        # For display purposes, it's better to check the modifier byte directly.
-        # self.CODE_TO_NAME[0xE0] = "LEFT_CTRL" # Example, not a real keycode for Left Ctrl alone in report byte 2-7
-
-
-    def get_codes(self, key_name):
-        """Returns (modifier_mask, key_code) tuple for a given key name."""
-        key_name_upper = key_name.upper()
-        # For modifier keys like "LEFT_CTRL", the key_code part is 0x00 as they only set bits in the modifier byte.
-        return self.NAME_TO_CODE.get(key_name_upper, (self.MOD_NONE, 0x00)) # Return (MOD_NONE, 0x00) for "NONE" or unknown
+    __slots__ = () # Stateless: everything lives in the module-level tables
+
+    # Class attributes keep the existing keycode_map.MOD_* / .NAME_TO_CODE / .CODE_TO_NAME accessors working
+    MOD_NONE = MOD_NONE
+    MOD_LEFT_CTRL = MOD_LEFT_CTRL
+    MOD_LEFT_SHIFT = MOD_LEFT_SHIFT
+    MOD_LEFT_ALT = MOD_LEFT_ALT
+    MOD_LEFT_GUI = MOD_LEFT_GUI
+    MOD_RIGHT_CTRL = MOD_RIGHT_CTRL
+    MOD_RIGHT_SHIFT = MOD_RIGHT_SHIFT
+    MOD_RIGHT_ALT = MOD_RIGHT_ALT
+    MOD_RIGHT_GUI = MOD_RIGHT_GUI
+    NAME_TO_CODE = NAME_TO_CODE
+    CODE_TO_NAME = CODE_TO_NAME
+
+    get_codes = staticmethod(get_codes) # The shared cached function; keycode_map.get_codes(name) keeps working
+
+    def all_names(self):
+        """Returns all known key names."""
+        return list(_NAME_TO_CODE.keys())
 
     def get_name(self, key_code_to_find):
         """Returns primary key name for a given HID Usage ID (key code part from bytes 2-7).
            Does not resolve modifiers directly from this call.
         """
-        return self.CODE_TO_NAME.get(key_code_to_find, "UNKNOWN")
+        try:
+            if 0 <= key_code_to_find < 256:
+                return _CODE_TO_NAME_TABLE[key_code_to_find]
+        except TypeError: # Not an int
+            pass
+        return "UNKNOWN"
+
+    def get_modifier_names(self, modifier_mask):
+        """Returns the names of the modifiers set in a report's modifier byte, lowest bit first."""
+        return [name for bit, name in enumerate(_MODIFIER_BIT_NAMES) if modifier_mask & (1 << bit)]
@@ -5,7 +5,6 @@ import os
 import threading
 import argparse
 import logging
-from queue import Queue
 
 # Make sure backend modules can be imported
 sys.path.append(os.path.dirname(os.path.realpath(__file__)))
@@ -14,6 +13,7 @@ from input_handler import InputHandler
 from hid_service import HidService
 from config_manager import ConfigManager
 from web_server import WebServer
+from command_queue import CommandQueue
 
 # --- Configuration ---
 LOG_LEVEL = logging.INFO
@@ -24,7 +24,7 @@ KNOB_DEVICE_PATH = "/dev/input/eventX"  # Placeholder
 BUTTON_DEVICE_PATH = "/dev/input/eventY" # Placeholder
 
 # Queue for commands from input handler to HID service
-command_queue = Queue()
+command_queue = CommandQueue()
 
 # Setup logging
 logging.basicConfig(level=LOG_LEVEL, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -60,9 +60,8 @@ def main():
 
         # Start Web Server (Flask)
         web_server = WebServer(config_manager, input_handler) # Pass dependencies
-        # Run Flask in the main thread or its own thread if preferred
-        # Note: Flask's development server is not recommended for production.
-        # Consider using `waitress` or `gunicorn` via Nix if needed.
+        # Run the web server in the main thread or its own thread if preferred
+        # (waitress when installed, Flask's development server otherwise)
         logger.info("Starting Web Server...")
         web_server.run() # This will block the main thread
 
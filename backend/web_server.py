@@ -1,9 +1,26 @@
+import json
 import logging
-from flask import Flask, jsonify, render_template, request, send_from_directory
+from flask import Flask, Response, jsonify, render_template, request
 import os
 
+try:
+    from .config_manager import DEFAULT_ACTIONS # Imported as part of the backend package
+    from .keycodes import AVAILABLE_KEY_NAMES
+except ImportError:
+    from config_manager import DEFAULT_ACTIONS # backend/main.py puts backend/ itself on sys.path
+    from keycodes import AVAILABLE_KEY_NAMES
+
+try:
+    import waitress # Production WSGI server: thread pool, no per-request debugger setup
+except ImportError:
+    waitress = None # Fall back to Flask's built-in development server
+
 logger = logging.getLogger("WebServer")
 
+# Both lists are static: serialize them once instead of on every request
+_AVAILABLE_KEYS_JSON = json.dumps(AVAILABLE_KEY_NAMES).encode('utf-8')
+_AVAILABLE_ACTIONS_JSON = json.dumps(DEFAULT_ACTIONS).encode('utf-8') # The actions of the default config
+
 class WebServer:
     def __init__(self, config_manager, input_handler):
         self.config_manager = config_manager
@@ -13,10 +30,15 @@ class WebServer:
         frontend_folder = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'frontend'))
         logger.info(f"Serving frontend files from: {frontend_folder}")
 
-        # Use template_folder and static_folder arguments for Flask
+        # Use template_folder and static_folder arguments for Flask.
+        # static_url_path='' serves the frontend files at the site root through Flask's own static route
+        # (conditional requests, file_wrapper/sendfile under a production WSGI server)
         self.app = Flask(__name__,
                          template_folder=frontend_folder,
-                         static_folder=frontend_folder)
+                         static_folder=frontend_folder,
+                         static_url_path='')
+        # Let browsers reuse CSS/JS for a day instead of re-requesting them on every page load
+        self.app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 86400
 
         self.setup_routes()
 
@@ -26,15 +48,9 @@ class WebServer:
             # Render the main HTML page
             return render_template('index.html')
 
-        # Serve static files (CSS, JS) - Flask does this automatically if named 'static'
-        # but explicit route can be clearer or needed if folder name differs.
-        @self.app.route('/<path:filename>')
-        def serve_static(filename):
-             return send_from_directory(self.app.static_folder, filename)
-
         @self.app.route('/api/mappings', methods=['GET'])
         def get_mappings():
-            mappings = self.config_manager.get_mappings()
+            mappings = self.config_manager.get_mappings_mutable()
             return jsonify(mappings)
 
         @self.app.route('/api/mappings', methods=['POST'])
@@ -44,7 +60,7 @@ class WebServer:
                 if not new_mappings:
                     return jsonify({"status": "error", "message": "No data received"}), 400
 
-                logger.info(f"Received new mappings via API: {new_mappings}")
+                logger.info("Received new mappings via API: %s", new_mappings) # Lazy: the dict is only formatted if emitted
                 success = self.config_manager.update_mappings(new_mappings)
 
                 if success:
@@ -61,26 +77,17 @@ class WebServer:
         # Add routes for listing available keys/actions if needed
         @self.app.route('/api/available-keys', methods=['GET'])
         def get_available_keys():
-             # Import here to avoid circular dependency at module level if needed
-             from keycodes import KeycodeMap
-             kc_map = KeycodeMap()
-             return jsonify(list(kc_map.NAME_TO_CODE.keys()))
+             return Response(_AVAILABLE_KEYS_JSON, mimetype='application/json')
 
         @self.app.route('/api/available-actions', methods=['GET'])
         def get_available_actions():
-            # These are the keys used in the default config and input_handler
-             actions = [
-                 "knob_cw", "knob_ccw",
-                 "front_button_press", "front_button_release",
-                 "top_button_1_press", "top_button_1_release",
-                 "top_button_2_press", "top_button_2_release",
-                 "top_button_3_press", "top_button_3_release",
-                 "top_button_4_press", "top_button_4_release",
-             ]
-             return jsonify(actions)
+             return Response(_AVAILABLE_ACTIONS_JSON, mimetype='application/json')
 
 
     def run(self, host='0.0.0.0', port=5000, debug=False):
+         if waitress is not None and not debug: # debug=True needs the Werkzeug server (reloader, debugger)
+             logger.info(f"Starting waitress server on {host}:{port}")
+             waitress.serve(self.app, host=host, port=port, threads=4)
+             return
          logger.info(f"Starting Flask server on {host}:{port}")
-         # Use 'waitress' or 'gunicorn' for a more production-ready server via Nix config
          self.app.run(host=host, port=port, debug=debug)
\ No newline at end of file
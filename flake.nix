@@ -28,6 +28,8 @@
             evdev
             dbus-python
             pygobject3 # For GLib main loop in HidService
+            orjson # Fast config.json load/save (ConfigManager falls back to stdlib json)
+            pyudev # Input device hotplug (InputHandler falls back to periodic reconnects)
 
           ];
 
@@ -17,16 +17,16 @@ from kivy.clock import Clock, mainthread
 from kivy.core.window import Window
 
 import threading
-from queue import Queue
 import os
 import logging
 import json # For a more complex key picker later
 
 # Project backend modules
-from backend.config_manager import ConfigManager
-from backend.keycodes import KeycodeMap
+from backend.config_manager import ConfigManager, DEFAULT_ACTIONS
+from backend import keycodes
 from backend.input_handler import InputHandler
 from backend.hid_service import HidService
+from backend.command_queue import CommandQueue
 
 # --- Logging Configuration ---
 # Kivy's logger can be used, or Python's standard logging
@@ -34,7 +34,18 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(level
 logger = logging.getLogger("MacroPadApp")
 
 # --- Global Command Queue for HID Service ---
-command_queue = Queue()
+command_queue = CommandQueue()
+
+# Mapping type <-> label shown in the type spinner, built once instead of per call
+_TYPE_DISPLAY = {
+    "key_tap": "Tap (Press & Release)",
+    "key_press": "Press Only",
+    "key_release": "Release Only",
+    "none": "None"
+}
+_TYPE_INTERNAL = {display: internal for internal, display in _TYPE_DISPLAY.items()}
+# Row labels for the known actions; other names are formatted on the fly
+_ACTION_DISPLAY_NAMES = {name: name.replace("_", " ").title() for name in DEFAULT_ACTIONS}
 
 # --- Kivy UI Elements ---
 
@@ -65,7 +76,7 @@ class MappingEntryWidget(RecycleDataViewBehavior, BoxLayout):
 
     def on_edit_press(self, action_name):
         if self.app_instance_prop:
-            logger.info(f"Edit pressed for: {action_name}")
+            logger.info("Edit pressed for: %s", action_name)
             self.app_instance_prop.edit_specific_mapping(action_name)
 
 
@@ -80,7 +91,8 @@ class EditMappingScreen(Screen):
         self.app_instance = app_instance
         self.current_action_name = ""
         self.current_keys = []
-        self.available_key_names = sorted(list(self.app_instance.keycode_map.NAME_TO_CODE.keys()))
+        self._current_keys_set = set() # Mirrors current_keys for membership tests
+        self.available_key_names = self.app_instance.keycode_map.AVAILABLE_KEY_NAMES # Sorted once at import
 
     def load_action(self, action_name):
         self.current_action_name = action_name
@@ -93,6 +105,7 @@ class EditMappingScreen(Screen):
         self.action_name_label.text = f"Editing: {self.app_instance.format_action_name_display(action_name)}"
         self.type_spinner.text = self.app_instance.format_type_name_display(mapping.get('type', 'none'))
         self.current_keys = list(mapping.get('keys', [])) # Make a mutable copy
+        self._current_keys_set = set(self.current_keys)
         self.update_keys_display()
 
     def update_keys_display(self):
@@ -108,12 +121,13 @@ class EditMappingScreen(Screen):
                 key_to_add = "A" # Placeholder, should come from picker
                 # Find a key that is not 'NONE' and not already in current_keys
                 for key_name_option in self.available_key_names:
-                    if key_name_option != "NONE" and key_name_option not in self.current_keys:
+                    if key_name_option != "NONE" and key_name_option not in self._current_keys_set:
                         key_to_add = key_name_option
                         break
 
-                if key_to_add not in self.current_keys:
+                if key_to_add not in self._current_keys_set:
                     self.current_keys.append(key_to_add)
+                    self._current_keys_set.add(key_to_add)
                     self.update_keys_display()
                 else:
                     self.app_instance.show_status_popup("Info", f"{key_to_add} is already added.")
@@ -123,7 +137,9 @@ class EditMappingScreen(Screen):
 
     def remove_last_key(self):
         if self.current_keys:
-            self.current_keys.pop()
+            removed = self.current_keys.pop()
+            if removed not in self.current_keys: # Loaded configs may list a key twice
+                self._current_keys_set.discard(removed)
             self.update_keys_display()
 
     def save_current_mapping(self):
@@ -131,15 +147,18 @@ class EditMappingScreen(Screen):
             return
 
         action_type_internal = self.app_instance.format_type_name_internal(self.type_spinner.text)
-        updated_mappings = self.app_instance.config_manager.get_mappings()
-        updated_mappings[self.current_action_name] = {
+        new_mapping = {
             "type": action_type_internal,
             "keys": list(self.current_keys) # Save a copy
         }
-        if self.app_instance.config_manager.update_mappings(updated_mappings):
-            self.app_instance.show_status_popup("Success", "Mapping saved!")
-            self.app_instance.input_handler.load_mappings() # Crucial: reload in input_handler
-            self.app_instance.refresh_mappings_display_on_config_screen()
+        # Only this action changed: patch it in instead of round-tripping the whole mappings dict.
+        # The file write is debounced, so quick successive edits are saved once.
+        if self.app_instance.config_manager.update_action(self.current_action_name, new_mapping):
+            # The file is written a moment later; a failed write is reported by on_config_save_error
+            self.app_instance.show_status_popup("Success", "Mapping updated.")
+            if self.app_instance.input_handler: # Not created yet: it loads the saved mappings when it starts
+                self.app_instance.input_handler.load_mappings() # Crucial: reload in input_handler
+            self.app_instance.refresh_mapping_on_config_screen(self.current_action_name)
             self.go_back()
         else:
             self.app_instance.show_status_popup("Error", "Failed to save mapping.")
@@ -155,8 +174,17 @@ class ConfigScreen(Screen):
     def __init__(self, app_instance, **kwargs):
         super().__init__(**kwargs)
         self.app_instance = app_instance
+        self._action_index = {} # {action_name: row index in mappings_rv.data}
         Clock.schedule_once(self.populate_mappings, 0.1) # Populate after UI is built
 
+    def _row_data(self, action_name, mapping):
+        return {
+            'action_name': action_name,
+            'action_type': self.app_instance.format_type_name_display(mapping.get('type', 'none')),
+            'keys': mapping.get('keys', []),
+            'app_instance': self.app_instance # Pass app instance for callbacks
+        }
+
     def populate_mappings(self, *args):
         mappings_data = []
         raw_mappings = self.app_instance.config_manager.get_mappings()
@@ -164,21 +192,26 @@ class ConfigScreen(Screen):
         sorted_action_names = sorted(raw_mappings.keys())
 
         for action_name in sorted_action_names:
-            mapping = raw_mappings[action_name]
-            mappings_data.append({
-                'action_name': action_name,
-                'action_type': self.app_instance.format_type_name_display(mapping.get('type', 'none')),
-                'keys': mapping.get('keys', []),
-                'app_instance': self.app_instance # Pass app instance for callbacks
-            })
+            mappings_data.append(self._row_data(action_name, raw_mappings[action_name]))
         if self.mappings_rv:
             self.mappings_rv.data = mappings_data
+            self._action_index = {name: i for i, name in enumerate(sorted_action_names)}
         else:
             logger.warning("Mappings RV not available yet in ConfigScreen.")
 
     def refresh_mappings(self):
         self.populate_mappings()
 
+    def update_one(self, action_name):
+        """Replaces the row of a single edited action in place instead of rebuilding every row."""
+        index = self._action_index.get(action_name)
+        mapping = self.app_instance.config_manager.get_mappings().get(action_name)
+        if index is None or mapping is None or not self.mappings_rv:
+            self.populate_mappings() # New or removed action: the row order changes
+            return
+        # Item assignment on the data ListProperty tells the RecycleView which row changed
+        self.mappings_rv.data[index] = self._row_data(action_name, mapping)
+
 class StatusPopup(BoxLayout):
     status_title = StringProperty('')
     status_text = StringProperty('')
@@ -203,8 +236,32 @@ class MacroPadGUIApp(App):
         logger.info(f"Using configuration file: {config_file_path}")
 
         self.config_manager = ConfigManager(config_file_path)
-        self.keycode_map = KeycodeMap()
+        self.config_manager.on_deferred_save_error = self.on_config_save_error
+        self.keycode_map = keycodes # Module-level tables, built once at import
+
+        # Backend services are created by _start_backend once the first frame is up
+        self.hid_service = None
+        self.input_handler = None
+        self.hid_thread = None
+        self.input_thread = None
+
+        # Setup Kivy Screen Manager
+        self.screen_manager = ScreenManager()
+        self.config_screen = ConfigScreen(name='config', app_instance=self)
+        self.edit_mapping_screen = EditMappingScreen(name='edit_mapping', app_instance=self)
+
+        self.screen_manager.add_widget(self.config_screen)
+        self.screen_manager.add_widget(self.edit_mapping_screen)
+
+        # Open devices, D-Bus and threads on the next frame, so the window renders without waiting for them
+        Clock.schedule_once(self._start_backend, 0)
+
+        # For debugging input events (optional)
+        # Clock.schedule_interval(self.check_command_queue_debug, 1)
+        return self.screen_manager
 
+    def _start_backend(self, dt):
+        """Finds the input devices, creates the backend services and starts their threads."""
         # --- Critical: Define correct device paths ---
         # These paths MUST be discovered using `evtest` on the Car Thing
         # and ideally passed via environment variables or a config file managed by NixOS.
@@ -247,43 +304,22 @@ class MacroPadGUIApp(App):
         self.input_thread.start()
         logger.info("Input Handler thread started.")
 
-        # Setup Kivy Screen Manager
-        self.screen_manager = ScreenManager()
-        self.config_screen = ConfigScreen(name='config', app_instance=self)
-        self.edit_mapping_screen = EditMappingScreen(name='edit_mapping', app_instance=self)
-
-        self.screen_manager.add_widget(self.config_screen)
-        self.screen_manager.add_widget(self.edit_mapping_screen)
-
-        # For debugging input events (optional)
-        # Clock.schedule_interval(self.check_command_queue_debug, 1)
-        return self.screen_manager
-
     def check_command_queue_debug(self, dt):
-        # For debugging if HID commands are being generated
-        if not command_queue.empty():
-            item = command_queue.queue[0] # Peek
-            logger.debug(f"DEBUG: Command Queue peek: {item}")
+        # For debugging if HID commands are being generated. Only the length is read: peeking at items
+        # would race the consumer popping them on the HID thread.
+        size = command_queue.qsize()
+        if size > 0:
+            logger.debug("DEBUG: Command Queue size: %d", size)
 
 
     def format_action_name_display(self, action_name_internal):
-        return action_name_internal.replace("_", " ").title()
+        return _ACTION_DISPLAY_NAMES.get(action_name_internal) or action_name_internal.replace("_", " ").title()
 
     def format_type_name_display(self, type_name_internal):
-        return {
-            "key_tap": "Tap (Press & Release)",
-            "key_press": "Press Only",
-            "key_release": "Release Only",
-            "none": "None"
-        }.get(type_name_internal, type_name_internal.title())
+        return _TYPE_DISPLAY.get(type_name_internal) or type_name_internal.title()
 
     def format_type_name_internal(self, type_name_display):
-         return {
-            "Tap (Press & Release)": "key_tap",
-            "Press Only": "key_press",
-            "Release Only": "key_release",
-            "None": "none"
-        }.get(type_name_display, type_name_display.lower())
+        return _TYPE_INTERNAL.get(type_name_display) or type_name_display.lower()
 
 
     def edit_specific_mapping(self, action_name):
@@ -295,6 +331,14 @@ class MacroPadGUIApp(App):
         if self.config_screen:
             self.config_screen.refresh_mappings()
 
+    def refresh_mapping_on_config_screen(self, action_name):
+        if self.config_screen:
+            self.config_screen.update_one(action_name)
+
+    def on_config_save_error(self):
+        """Called from ConfigManager's save timer thread: show the popup on the Kivy thread."""
+        Clock.schedule_once(lambda dt: self.show_status_popup("Error", "Failed to save mapping to disk."), 0)
+
     def show_status_popup(self, title, message):
         from kivy.uix.popup import Popup
         content = StatusPopup(status_title=title, status_text=message)
@@ -308,6 +352,8 @@ class MacroPadGUIApp(App):
 
     def on_stop(self):
         logger.info("Stopping MacroPad Application...")
+        if hasattr(self, 'config_manager'):
+            self.config_manager.flush() # Write a mapping edit still waiting on the save debounce
         if hasattr(self, 'input_handler') and self.input_handler:
             self.input_handler.stop()
         if hasattr(self, 'hid_service') and self.hid_service:
@@ -318,9 +364,9 @@ class MacroPadGUIApp(App):
 
         # Wait for threads to finish
         threads_to_join = []
-        if hasattr(self, 'input_thread') and self.input_thread.is_alive():
+        if getattr(self, 'input_thread', None) and self.input_thread.is_alive():
             threads_to_join.append(self.input_thread)
-        if hasattr(self, 'hid_thread') and self.hid_thread.is_alive():
+        if getattr(self, 'hid_thread', None) and self.hid_thread.is_alive():
             threads_to_join.append(self.hid_thread)
 
         for t in threads_to_join:
@@ -329,6 +375,8 @@ class MacroPadGUIApp(App):
             if t.is_alive():
                 logger.warning(f"Thread {t.name} did not terminate in time.")
 
+        if not any(t.is_alive() for t in threads_to_join):
+            command_queue.close() # Producer and consumer are gone, release the wakeup fd
         logger.info("Application stopped.")
 
 if __name__ == '__main__':
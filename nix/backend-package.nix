@@ -11,8 +11,11 @@ pkgs.python3Packages.buildPythonApplication {
   # Runtime dependencies needed by the Python code
   propagatedBuildInputs = with pkgs.python3Packages; [
     flask # For the web UI and API
+    waitress # WSGI server for the web UI (optional, falls back to Flask's dev server)
     evdev # For reading input devices
     dbus-python # For BlueZ D-Bus communication
+    orjson # Fast config.json load/save (optional, falls back to stdlib json)
+    pyudev # Input device hotplug (optional, falls back to periodic reconnects)
     # Add other Python libraries if needed (e.g., requests, pyserial)
   ];
 